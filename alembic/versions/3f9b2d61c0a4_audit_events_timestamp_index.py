@@ -0,0 +1,24 @@
+"""Index audit events by timestamp
+
+Revision ID: 3f9b2d61c0a4
+Revises: 5c8101ff14d7
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '3f9b2d61c0a4'
+down_revision = '5c8101ff14d7'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # Audit retention walks the table oldest first across all consoles, which
+    # the (source, uuid, timestamp) primary key cannot help with.
+    op.create_index('auditevents_timestamp', 'auditevents', ['timestamp'])
+
+
+def downgrade() -> None:
+    op.drop_index('auditevents_timestamp', table_name='auditevents')
@@ -0,0 +1,30 @@
+"""Add version counters
+
+Revision ID: 9e4a7c2b5d18
+Revises: 3f9b2d61c0a4
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9e4a7c2b5d18'
+down_revision = '3f9b2d61c0a4'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    versions = op.create_table(
+        'versions',
+        sa.Column('name', sa.String(255)),
+        sa.Column('version', sa.BigInteger, nullable=False),
+        sa.Column('updated', sa.DateTime),
+        sa.PrimaryKeyConstraint('name')
+    )
+    op.bulk_insert(versions, [{'name': 'inventory', 'version': 1}])
+
+
+def downgrade() -> None:
+    op.drop_table('versions')
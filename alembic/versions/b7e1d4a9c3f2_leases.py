@@ -0,0 +1,30 @@
+"""Add leases
+
+Revision ID: b7e1d4a9c3f2
+Revises: 9e4a7c2b5d18
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b7e1d4a9c3f2'
+down_revision = '9e4a7c2b5d18'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    leases = op.create_table(
+        'leases',
+        sa.Column('name', sa.String(255)),
+        sa.Column('holder', sa.String(255)),
+        sa.Column('expires', sa.DateTime),
+        sa.PrimaryKeyConstraint('name')
+    )
+    op.bulk_insert(leases, [{'name': 'maintenance'}])
+
+
+def downgrade() -> None:
+    op.drop_table('leases')
@@ -0,0 +1,27 @@
+"""Source circuit breakers
+
+Revision ID: c4f8a2e6d1b9
+Revises: b7e1d4a9c3f2
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c4f8a2e6d1b9'
+down_revision = 'b7e1d4a9c3f2'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column('sources', sa.Column('breaker_state', sa.String(255)))
+    op.add_column('sources', sa.Column('breaker_failures', sa.Integer()))
+    op.add_column('sources', sa.Column('breaker_retry_at', sa.DateTime()))
+
+
+def downgrade() -> None:
+    op.drop_column('sources', 'breaker_retry_at')
+    op.drop_column('sources', 'breaker_failures')
+    op.drop_column('sources', 'breaker_state')
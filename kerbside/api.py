@@ -5,6 +5,10 @@
 # the outer decorator is executed first!                                        #
 #################################################################################
 
+import atexit
+import base64
+from collections import OrderedDict
+from concurrent import futures
 import datetime
 import flask
 from flask_jwt_extended import (
@@ -13,6 +17,8 @@ from flask_jwt_extended import (
 from flask_jwt_extended.exceptions import NoAuthorizationError
 from flask_request_id import RequestID
 import flask_restful
+import hashlib
+import io
 import json
 from keystoneauth1 import exceptions as keystone_exceptions
 from keystoneauth1.identity import v3 as keystone_v3
@@ -20,18 +26,29 @@ from keystoneauth1 import session as keystone_session
 from keystoneclient.v3 import client as keystone_client
 import logging
 import os
+from prometheus_client import (
+    CollectorRegistry, Histogram, multiprocess, start_http_server)
+import psutil
+import queue
 import setproctitle
 from shakenfist_utilities import api as sf_api, logs
 import signal
+import shutil
 import subprocess
 import sys
+import threading
+import time
+import urllib.parse
+import zipfile
 from webargs import fields
 from webargs.flaskparser import use_kwargs
 
+from . import cache
+from . import changes
 from .config import config
 from . import consoletoken
 from . import db
-from .sources import ovirt as ovirt_source
+from .sources import registry as source_registry
 from . import util
 
 
@@ -50,6 +67,99 @@ app.logger.handlers = [HANDLER]
 app.config['JWT_SECRET_KEY'] = config.AUTH_SECRET_SEED
 jwt = JWTManager(app)
 
+# Source drivers hold connections and threads, so we close them when a gunicorn
+# worker exits.
+atexit.register(source_registry.close_all)
+
+
+# Metrics are recorded by each gunicorn worker into PROMETHEUS_MULTIPROC_DIR,
+# which is set by run() before gunicorn is started, and then exported by the
+# kerbside-api process.
+KEYSTONE_LATENCY = Histogram(
+    'keystone_request_seconds', 'Time taken by keystone requests made by the API',
+    ['operation'])
+
+
+# Per worker keystone state. The service session re-authenticates itself when
+# its token nears expiry, so we only need to build it once per worker.
+KEYSTONE_SERVICE_CLIENT = None
+KEYSTONE_ACCESS_GROUP_ID = None
+KEYSTONE_ACCESS_GROUP_FETCHED = 0
+
+# Positive group membership results, keyed by user and group and holding when
+# they expire. As the keys come from requests this is a bounded LRU.
+KEYSTONE_MEMBERSHIP_CACHE = OrderedDict()
+KEYSTONE_MEMBERSHIP_CACHE_LOCK = threading.Lock()
+
+
+def _get_service_keystone():
+    global KEYSTONE_SERVICE_CLIENT
+
+    if not KEYSTONE_SERVICE_CLIENT:
+        service_auth = keystone_v3.Password(
+            auth_url=config.KEYSTONE_AUTH_URL,
+            username=config.KEYSTONE_SERVICE_AUTH_USER,
+            password=config.KEYSTONE_SERVICE_AUTH_PASSWORD,
+            project_name=config.KEYSTONE_SERVICE_AUTH_PROJECT,
+            user_domain_id=config.KEYSTONE_SERVICE_AUTH_USER_DOMAIN_ID,
+            project_domain_id=config.KEYSTONE_SERVICE_AUTH_PROJECT_DOMAIN_ID)
+        service_session = keystone_session.Session(auth=service_auth)
+        KEYSTONE_SERVICE_CLIENT = keystone_client.Client(session=service_session)
+    return KEYSTONE_SERVICE_CLIENT
+
+
+def _reset_service_keystone():
+    global KEYSTONE_SERVICE_CLIENT
+    global KEYSTONE_ACCESS_GROUP_ID
+
+    KEYSTONE_SERVICE_CLIENT = None
+    KEYSTONE_ACCESS_GROUP_ID = None
+
+
+def _get_access_group_id():
+    global KEYSTONE_ACCESS_GROUP_ID
+    global KEYSTONE_ACCESS_GROUP_FETCHED
+
+    if (KEYSTONE_ACCESS_GROUP_ID and
+            time.time() - KEYSTONE_ACCESS_GROUP_FETCHED < config.KEYSTONE_GROUP_CACHE_TTL):
+        return KEYSTONE_ACCESS_GROUP_ID
+
+    with KEYSTONE_LATENCY.labels('list_groups').time():
+        groups = _get_service_keystone().groups.list(name=config.KEYSTONE_ACCESS_GROUP)
+
+    KEYSTONE_ACCESS_GROUP_ID = None
+    for g in groups:
+        if g.name == config.KEYSTONE_ACCESS_GROUP:
+            KEYSTONE_ACCESS_GROUP_ID = g.id
+            KEYSTONE_ACCESS_GROUP_FETCHED = time.time()
+    return KEYSTONE_ACCESS_GROUP_ID
+
+
+def _user_in_access_group(user_id, group_id):
+    # Only positive results are cached, so that users added to the group can
+    # log in immediately.
+    key = (user_id, group_id)
+    with KEYSTONE_MEMBERSHIP_CACHE_LOCK:
+        cached = KEYSTONE_MEMBERSHIP_CACHE.get(key)
+        if cached and time.time() < cached:
+            KEYSTONE_MEMBERSHIP_CACHE.move_to_end(key)
+            return True
+        KEYSTONE_MEMBERSHIP_CACHE.pop(key, None)
+
+    try:
+        with KEYSTONE_LATENCY.labels('check_in_group').time():
+            _get_service_keystone().users.check_in_group(user_id, group_id)
+    except keystone_exceptions.http.NotFound:
+        return False
+
+    if config.KEYSTONE_MEMBERSHIP_CACHE_TTL > 0:
+        with KEYSTONE_MEMBERSHIP_CACHE_LOCK:
+            KEYSTONE_MEMBERSHIP_CACHE[key] = \
+                time.time() + config.KEYSTONE_MEMBERSHIP_CACHE_TTL
+            while len(KEYSTONE_MEMBERSHIP_CACHE) > config.KEYSTONE_MEMBERSHIP_CACHE_SIZE:
+                KEYSTONE_MEMBERSHIP_CACHE.popitem(last=False)
+    return True
+
 
 # A decorator to protect endpoints which require authentication
 def verify_token(func):
@@ -73,6 +183,54 @@ class DateTimeEncoder(json.JSONEncoder):
             return super().default(value)
 
 
+# API responses are compact JSON unless the client asks for pretty printing
+# with ?pretty=true. Large listings are streamed so that we never hold both the
+# full listing and its serialised form in memory.
+def _wants_pretty():
+    return flask.request.args.get('pretty', 'false').lower() in ['1', 'true', 'yes']
+
+
+def _dumps(value, pretty=False):
+    if pretty:
+        return json.dumps(value, indent=4, sort_keys=True, cls=DateTimeEncoder)
+    return json.dumps(value, separators=(',', ':'), sort_keys=True, cls=DateTimeEncoder)
+
+
+def _json_response(value):
+    return flask.Response(_dumps(value, pretty=_wants_pretty()),
+                          mimetype='application/json')
+
+
+def _json_list_response(items):
+    if _wants_pretty():
+        return _json_response(list(items))
+
+    def generate():
+        yield '['
+        separator = ''
+        for item in items:
+            yield separator + _dumps(item)
+            separator = ','
+        yield ']'
+
+    return flask.Response(generate(), mimetype='application/json')
+
+
+def _json_dict_response(pairs):
+    if _wants_pretty():
+        return _json_response(dict(pairs))
+
+    def generate():
+        yield '{'
+        separator = ''
+        for key, value in pairs:
+            yield '%s%s:%s' % (separator, _dumps(key), _dumps(value))
+            separator = ','
+        yield '}'
+
+    return flask.Response(generate(), mimetype='application/json')
+
+
 def get_nav_items(current):
     base_navitems = [
         {
@@ -134,23 +292,49 @@ class Root(sf_api.Resource):
         return resp
 
 
+# The kerbside-api process records the discovery version when it started in
+# its environment, which gunicorn workers inherit. Once a worker has seen a
+# fresh inventory it stays ready.
+READY = False
+STARTED_DISCOVERY_VERSION = None
+
+
+class Ready(sf_api.Resource):
+    def get(self):
+        # This is unauthenticated, for use by load balancers. We serve from
+        # the existing inventory immediately on start up, and report that we
+        # are ready once every source has been polled since we started. This
+        # compares discovery version numbers rather than times, as discovery
+        # might be running on another node whose clock differs from ours.
+        global READY
+        global STARTED_DISCOVERY_VERSION
+
+        if STARTED_DISCOVERY_VERSION is None:
+            if os.environ.get('KERBSIDE_API_STARTED_DISCOVERY_VERSION'):
+                STARTED_DISCOVERY_VERSION = int(
+                    os.environ['KERBSIDE_API_STARTED_DISCOVERY_VERSION'])
+            else:
+                STARTED_DISCOVERY_VERSION = db.get_version(db.DISCOVERY_VERSION)
+
+        discovery_version = db.get_version(db.DISCOVERY_VERSION)
+        if not READY:
+            READY = discovery_version > STARTED_DISCOVERY_VERSION
+
+        resp = _json_response({
+            'ready': READY,
+            'discovery_version': discovery_version,
+            'discovered': db.get_version_updated(db.DISCOVERY_VERSION)
+        })
+        resp.status_code = 200 if READY else 503
+        return resp
+
+
 class Auth(sf_api.Resource):
     def post(self, username=None, password=None, as_cookie=False):
         # Validate arguments
         if not username or not password:
             return sf_api.error(400, 'bad request')
 
-        # We need to talk to Keystone as our service account
-        service_auth = keystone_v3.Password(
-            auth_url=config.KEYSTONE_AUTH_URL,
-            username=config.KEYSTONE_SERVICE_AUTH_USER,
-            password=config.KEYSTONE_SERVICE_AUTH_PASSWORD,
-            project_name=config.KEYSTONE_SERVICE_AUTH_PROJECT,
-            user_domain_id=config.KEYSTONE_SERVICE_AUTH_USER_DOMAIN_ID,
-            project_domain_id=config.KEYSTONE_SERVICE_AUTH_PROJECT_DOMAIN_ID)
-        service_session = keystone_session.Session(auth=service_auth)
-        service_keystone = keystone_client.Client(session=service_session)
-
         # Authenticate the user
         try:
             user_auth = keystone_v3.Password(
@@ -161,23 +345,28 @@ class Auth(sf_api.Resource):
                 user_domain_id='default',
                 project_domain_id='default')
             user_session = keystone_session.Session(auth=user_auth)
-            user_id = user_session.get_user_id()
+            with KEYSTONE_LATENCY.labels('authenticate').time():
+                user_id = user_session.get_user_id()
         except keystone_exceptions.http.Unauthorized:
             return sf_api.error(401, 'unauthorized')
 
-        # Ensure the user is in the correct group
-        group = None
-        for g in service_keystone.groups.list():
-            if g.name == config.KEYSTONE_ACCESS_GROUP:
-                group = g
-        if not group:
-            return sf_api.error(500, 'service group not found')
+        # Require that the user be in the correct group. This uses our cached
+        # service session, so if that has been rejected we rebuild it and try
+        # once more.
+        for attempt in range(2):
+            try:
+                group_id = _get_access_group_id()
+                if not group_id:
+                    return sf_api.error(500, 'service group not found')
 
-        # Require that the user be in that group
-        try:
-            service_keystone.users.check_in_group(user_id, group.id)
-        except keystone_exceptions.http.NotFound:
-            return sf_api.error(401, 'unauthorized')
+                if not _user_in_access_group(user_id, group_id):
+                    return sf_api.error(401, 'unauthorized')
+                break
+
+            except keystone_exceptions.http.Unauthorized:
+                _reset_service_keystone()
+                if attempt > 0:
+                    return sf_api.error(500, 'service authentication failed')
 
         # Create a JWT containing the user's keystone token
         token = user_session.get_token()
@@ -218,25 +407,32 @@ class Auth(sf_api.Resource):
         return resp
 
 
+def _with_breaker_states(sources):
+    # Circuit breaker state changes without the inventory version changing,
+    # so cached sources are updated with the current state.
+    states = db.get_source_breaker_states()
+    for source in sources:
+        source.update(states.get(source['name'], {}))
+    return sources
+
+
 class Sources(sf_api.Resource):
     @verify_token
     def get(self):
+        sources = _with_breaker_states(cache.get_sources())
         if flask.request.headers.get('Accept', 'text/html').find('text/html') != -1:
             resp = flask.Response(
                 flask.render_template(
-                    'sources.html', sources=db.get_sources(),
+                    'sources.html', sources=sources,
                     navitems=get_nav_items('Sources'),
-                    refresh=True, when=datetime.datetime.now()),
+                    live=['inventory_changed', 'source_changed'],
+                    when=datetime.datetime.now()),
                 mimetype='text/html')
         else:
-            sources = []
-            for source in db.get_sources():
+            for source in sources:
                 del source['password']
-                sources.append(source)
 
-            resp = flask.Response(
-                json.dumps(sources, indent=4, sort_keys=True, cls=DateTimeEncoder),
-                mimetype='application/json')
+            resp = _json_response(sources)
         resp.status_code = 200
         return resp
 
@@ -245,38 +441,127 @@ class Source(sf_api.Resource):
     @verify_token
     def get(self, uuid):
         # This is a REST API only call
-        source = db.get_source(uuid)
+        source = cache.get_source(uuid)
         if not source:
             return sf_api.error(404, 'source not found')
+        source = _with_breaker_states([source])[0]
 
-        resp = flask.Response(
-            json.dumps(source, indent=4, sort_keys=True, cls=DateTimeEncoder),
-            mimetype='application/json')
+        resp = _json_response(source)
         resp.status_code = 200
         return resp
 
 
+def _encode_marker(values):
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+
+def _decode_marker(marker):
+    values = json.loads(base64.urlsafe_b64decode(marker.encode()))
+    if not isinstance(values, list) or len(values) != 2:
+        raise ValueError('invalid marker')
+    return values
+
+
+def _listing_etag(state):
+    # The ETag covers the state of the data behind a listing as well as the
+    # request which was made for it, so that filtered or paginated requests
+    # have their own ETags.
+    return hashlib.sha256(json.dumps(
+        [state, flask.request.headers.get('Accept', 'text/html'),
+         flask.request.query_string.decode()],
+        sort_keys=True, cls=DateTimeEncoder).encode()).hexdigest()
+
+
+def _not_modified(etag):
+    resp = flask.Response(status=304)
+    resp.set_etag(etag, weak=True)
+    return resp
+
+
 class Consoles(sf_api.Resource):
+    get_args = {
+        'source': fields.Str(missing=None),
+        'name_prefix': fields.Str(missing=None),
+        'hypervisor': fields.Str(missing=None),
+        'marker': fields.Str(missing=None),
+        'limit': fields.Int(missing=None),
+        'fields': fields.Str(missing=None)
+    }
+
+    # These fields change without the inventory version changing
+    session_fields = ['sessions', 'token_count', 'audit']
+
     @verify_token
-    def get(self):
-        if flask.request.headers.get('Accept', 'text/html').find('text/html') != -1:
+    @use_kwargs(get_args, location='query')
+    def get(self, source=None, name_prefix=None, hypervisor=None, marker=None,
+            limit=None, fields=None):
+        html = flask.request.headers.get('Accept', 'text/html').find('text/html') != -1
+
+        if marker:
+            try:
+                marker = _decode_marker(marker)
+            except ValueError:
+                return sf_api.error(400, 'invalid marker')
+        if limit is not None and not 1 <= limit <= config.CONSOLE_PAGE_LIMIT:
+            return sf_api.error(
+                400, 'limit must be between 1 and %d' % config.CONSOLE_PAGE_LIMIT)
+        if fields:
+            fields = fields.split(',')
+
+        # If the client already has the current version of this listing, we
+        # can avoid building it. Listings which don't include session
+        # information only depend on the inventory version.
+        state = db.get_listing_state(
+            include_sessions=(html or not fields or
+                              bool(set(fields) & set(self.session_fields))))
+        etag = _listing_etag(state)
+        if flask.request.if_none_match.contains_weak(etag):
+            return _not_modified(etag)
+
+        # Unpaginated API listings are streamed from the database in batches
+        next_marker = None
+        if limit or html:
+            consoles = db.get_consoles(
+                include_audit=html, source=source, name_prefix=name_prefix,
+                hypervisor=hypervisor, marker=marker, limit=limit)
+            if limit and len(consoles) == limit:
+                next_marker = _encode_marker([consoles[-1]['name'], consoles[-1]['uuid']])
+        else:
+            consoles = db.iter_consoles(
+                source=source, name_prefix=name_prefix, hypervisor=hypervisor)
+
+        if html:
+            next_url = None
+            if next_marker:
+                next_url = '/console?%s' % urllib.parse.urlencode(
+                    dict(flask.request.args, marker=next_marker))
             resp = flask.Response(
                 flask.render_template(
-                    'consoles.html', consoles=db.get_consoles(),
+                    'consoles.html', consoles=consoles, next_url=next_url,
                     navitems=get_nav_items('Consoles'),
-                    refresh=True, when=datetime.datetime.now()),
+                    live=['inventory_changed'],
+                    live_rows=['token_created', 'session_terminated',
+                               'channel_added', 'channel_removed'],
+                    when=datetime.datetime.now()),
                 mimetype='text/html')
         else:
-            out_consoles = []
-            for console in db.get_consoles(include_audit=False):
-                # Remove the hypervisor auth ticket
-                if 'ticket' in console:
-                    del console['ticket']
-                out_consoles.append(console)
-
-            resp = flask.Response(
-                json.dumps(out_consoles, indent=4, sort_keys=True, cls=DateTimeEncoder),
-                mimetype='application/json')
+            def out_consoles():
+                for console in consoles:
+                    # Remove the hypervisor auth ticket
+                    if 'ticket' in console:
+                        del console['ticket']
+                    del console['audit']
+
+                    if fields:
+                        console = {f: console[f] for f in fields if f in console}
+                    yield console
+
+            resp = _json_list_response(out_consoles())
+            if next_marker:
+                resp.headers['Link'] = '</console?%s>; rel="next"' % urllib.parse.urlencode(
+                    dict(flask.request.args, marker=next_marker))
+
+        resp.set_etag(etag, weak=True)
         resp.status_code = 200
         return resp
 
@@ -293,38 +578,117 @@ class Console(sf_api.Resource):
         if 'ticket' in console:
             del console['ticket']
 
+        resp = _json_response(console)
+        resp.status_code = 200
+        return resp
+
+
+class ConsoleRow(sf_api.Resource):
+    @verify_token
+    def get(self, source=None, uuid=None):
+        # The rendered row for one console, so that admin pages can update
+        # just the rows which the change feed says have changed.
+        consoles = db.get_consoles(include_audit=True, source=source, uuid=uuid)
+        if not consoles:
+            return sf_api.error(404, 'console not found')
+
         resp = flask.Response(
-            json.dumps(console, indent=4, sort_keys=True, cls=DateTimeEncoder),
-            mimetype='application/json')
+            flask.render_template('console_row.html', console=consoles[0]),
+            mimetype='text/html')
         resp.status_code = 200
         return resp
 
 
+def _parse_epoch(value):
+    # Times are passed as seconds since the epoch. They are parsed here rather
+    # than by webargs so that invalid values are reported as a bad request.
+    if value is None:
+        return None
+    return datetime.datetime.fromtimestamp(float(value))
+
+
 class ConsolesAudit(sf_api.Resource):
     get_args = {
-        'limit': fields.Int(missing=20)
+        'limit': fields.Int(missing=20),
+        'since': fields.Str(missing=None),
+        'until': fields.Str(missing=None),
+        'before': fields.Str(missing=None)
     }
 
     @verify_token
     @use_kwargs(get_args, location='query')
-    def get(self, source=None, uuid=None, limit=20):
+    def get(self, source=None, uuid=None, limit=20, since=None, until=None,
+            before=None):
+        # Events are paged backwards in time. The cursor for the next page is
+        # the timestamp of the oldest event returned, in seconds since the
+        # epoch like since and until.
+        try:
+            before = _parse_epoch(before)
+            since = _parse_epoch(since)
+            until = _parse_epoch(until)
+        except (ValueError, OverflowError, OSError):
+            return sf_api.error(400, 'invalid time range')
+
+        # Counting one more event than the limit tells us whether the total
+        # is exact.
+        total = db.count_audit_events(
+            source, uuid, since=since, until=until,
+            limit=config.AUDIT_COUNT_LIMIT + 1)
+        total_is_estimate = total > config.AUDIT_COUNT_LIMIT
+        if total_is_estimate:
+            total = config.AUDIT_COUNT_LIMIT
+        events = db.get_audit_events(
+            source, uuid, limit=limit, since=since, until=until, before=before)
+
+        next_before = None
+        if events and len(events) == limit:
+            next_before = events[0]['timestamp'].timestamp()
+
         if flask.request.headers.get('Accept', 'text/html').find('text/html') != -1:
             resp = flask.Response(
                 flask.render_template(
-                    'audit.html', console=db.get_console(source, uuid),
-                    total_events=db.count_audit_events(source, uuid),
-                    events=db.get_audit_events(source, uuid, limit=limit),
+                    'audit.html', console=cache.get_console(source, uuid),
+                    total_events=total, total_is_estimate=total_is_estimate,
+                    events=events, limit=limit, next_before=next_before,
                     navitems=get_nav_items('Audit'),
-                    refresh=True, when=datetime.datetime.now()),
+                    refresh=not before, when=datetime.datetime.now()),
                 mimetype='text/html')
         else:
             out = {
-                'total': db.count_audit_events(source, uuid),
-                'audit': db.get_audit_events(source, uuid, limit=limit)
+                'total': total,
+                'total_is_estimate': total_is_estimate,
+                'audit': events,
+                'next_before': next_before
             }
-            resp = flask.Response(
-                json.dumps(out, indent=4, sort_keys=True, cls=DateTimeEncoder),
-                mimetype='application/json')
+            resp = _json_response(out)
+        resp.status_code = 200
+        return resp
+
+
+class ConsolesAuditExport(sf_api.Resource):
+    get_args = {
+        'since': fields.Str(missing=None),
+        'until': fields.Str(missing=None)
+    }
+
+    @verify_token
+    @use_kwargs(get_args, location='query')
+    def get(self, source=None, uuid=None, since=None, until=None):
+        # Stream all matching events as JSON lines, oldest first. This is a
+        # REST API only call.
+        try:
+            since = _parse_epoch(since)
+            until = _parse_epoch(until)
+        except (ValueError, OverflowError, OSError):
+            return sf_api.error(400, 'invalid time range')
+
+        def generate():
+            for event in db.iter_audit_events(source, uuid, since=since, until=until):
+                yield _dumps(event) + '\n'
+
+        resp = flask.Response(generate(), mimetype='application/x-ndjson')
+        resp.headers['Content-Disposition'] = (
+            'attachment; filename="%s-%s-audit.jsonl"' % (source, uuid))
         resp.status_code = 200
         return resp
 
@@ -350,28 +714,138 @@ tls-ciphers=DEFAULT%(ca_cert)s%(host_subject)s
 """
 
 
+# The parts of proxy vv files which are the same for every console, with only
+# the token and name left to be substituted. This is rebuilt if our CA
+# certificate changes on disk.
+PROXY_VV_TEMPLATE = None
+PROXY_VV_CACERT_MTIME = None
+
+
+def _get_proxy_vv_template():
+    global PROXY_VV_TEMPLATE
+    global PROXY_VV_CACERT_MTIME
+
+    mtime = os.stat(config.CACERT_PATH).st_mtime_ns
+    if PROXY_VV_TEMPLATE and mtime == PROXY_VV_CACERT_MTIME:
+        return PROXY_VV_TEMPLATE
+
+    with open(config.CACERT_PATH) as f:
+        cacert = f.read()
+    cacert = cacert.replace('\n', '\\n')
+
+    if config.PROXY_HOST_SUBJECT:
+        host_subject = '\nhost-subject=%s' % config.PROXY_HOST_SUBJECT
+    else:
+        host_subject = ''
+
+    # The static values are escaped so that the result is still a valid
+    # template for the final substitution.
+    PROXY_VV_TEMPLATE = VIRTVIEWER_TEMPLATE % {
+        'node': config.PUBLIC_FQDN.replace('%', '%%'),
+        'port': config.VDI_INSECURE_PORT,
+        'tls_port': '\ntls-port=%s' % config.VDI_SECURE_PORT,
+        'token': '%(token)s',
+        'ca_cert': '\nca=%s' % cacert.replace('%', '%%'),
+        'name': '%(name)s',
+        'host_subject': host_subject.replace('%', '%%')
+    }
+    PROXY_VV_CACERT_MTIME = mtime
+    return PROXY_VV_TEMPLATE
+
+
+TICKET_EXECUTOR = futures.ThreadPoolExecutor(
+    max_workers=config.BULK_TICKET_WORKERS, thread_name_prefix='kerbside-ticket')
+
+
+class SourceError(Exception):
+    ...
+
+
+def _get_driver(s):
+    # Building or refreshing a driver talks to the source, which might fail
+    try:
+        lookup = source_registry.get_driver(s)
+    except Exception as e:
+        LOG.with_fields({'source': s['name']}).warning(
+            'Failed to get driver for source: %s' % e)
+        raise SourceError('source %s is unavailable' % s['name'])
+
+    if lookup.errored:
+        raise SourceError('source %s is errored' % s['name'])
+    return lookup
+
+
+def _acquire_ticket(s, c):
+    # oVirt consoles require a ticket from the engine. We use a long lived
+    # driver for the source so that this is a single API call, but if that
+    # fails the driver's connection might be stale so we rebuild it and retry.
+    if s['type'] != 'ovirt':
+        return ''
+
+    for attempt in range(2):
+        lookup = _get_driver(s)
+        try:
+            _, ticket = lookup.get_console_for_vm(c['uuid'], acquire_ticket=True)
+            return ticket
+        except Exception as e:
+            LOG.with_fields(c).warning('Failed to acquire console ticket: %s' % e)
+            source_registry.discard(s['name'])
+
+    raise SourceError('failed to acquire ticket from source %s' % s['name'])
+
+
+def _resolve_console(s, uuid):
+    # Consoles are normally found by discovery, but an instance created since
+    # the last discovery cycle is looked up in its source directly and
+    # recorded, so that it can be used right away.
+    c = cache.get_console(s['name'], uuid)
+    if c or s.get('errored'):
+        return c
+
+    # Drivers return None for instances which do not exist or whose ids are
+    # invalid. Other errors are reported, but the driver is only rebuilt if it
+    # has lost its connection to the source or its authentication.
+    lookup = _get_driver(s)
+    try:
+        c = lookup.get_console(uuid)
+    except Exception as e:
+        LOG.with_fields({'source': s['name'], 'uuid': uuid}).warning(
+            'Failed to look up undiscovered console: %s' % e)
+        if lookup.is_connection_error(e):
+            source_registry.discard(s['name'])
+        raise SourceError('failed to look up console in source %s' % s['name'])
+    if not c:
+        return None
+
+    LOG.with_fields(c).info('Found undiscovered console')
+    if db.add_console(**c):
+        db.add_audit_event(c['source'], c['uuid'], None, None, None, None,
+                           'Discovered new console')
+    return c
+
+
 class ConsolesDirectVirtViewer(sf_api.Resource):
     @verify_token
     def get(self, source=None, uuid=None):
-        c = db.get_console(source, uuid)
-        if not c:
-            return sf_api.error(404, 'console not found')
-
-        s = db.get_source(source)
+        s = cache.get_source(source)
         if not s:
             return sf_api.error(404, 'source not found')
 
+        try:
+            c = _resolve_console(s, uuid)
+        except SourceError:
+            return sf_api.error(404, 'source error')
+        if not c:
+            return sf_api.error(404, 'console not found')
+
         node = c['hypervisor']
         if not node:
             node = c['hypervisor_ip']
 
-        ticket = ''
-        if s['type'] == 'ovirt':
-            lookup = ovirt_source.oVirtSource(**s)
-            if lookup.errored:
-                return sf_api.error(404, 'source error')
-            _, ticket = lookup.get_console_for_vm(c['uuid'], acquire_ticket=True)
-            lookup.close()
+        try:
+            ticket = _acquire_ticket(s, c)
+        except SourceError:
+            return sf_api.error(404, 'source error')
 
         tls_port = ''
         if c['secure_port']:
@@ -406,43 +880,28 @@ class ConsolesDirectVirtViewer(sf_api.Resource):
 class ConsolesProxyVirtViewer(sf_api.Resource):
     @verify_token
     def get(self, source=None, uuid=None):
-        s = db.get_source(source)
+        s = cache.get_source(source)
         if not s:
             return sf_api.error(404, 'source not found')
 
-        c = db.get_console(source, uuid)
+        try:
+            c = _resolve_console(s, uuid)
+        except SourceError:
+            return sf_api.error(404, 'source error')
         if not c:
             return sf_api.error(404, 'console not found')
 
-        cacert = ''
-        with open(config.CACERT_PATH) as f:
-            cacert = f.read()
-        cacert = cacert.replace('\n', '\\n')
-
-        if config.PROXY_HOST_SUBJECT:
-            host_subject = '\nhost-subject=%s' % config.PROXY_HOST_SUBJECT
-        else:
-            host_subject = ''
-
         # Acquire a ticket if required
-        ticket = ''
-        if s['type'] == 'ovirt':
-            lookup = ovirt_source.oVirtSource(**s)
-            if lookup.errored:
-                return sf_api.error(404, 'source error')
-            _, ticket = lookup.get_console_for_vm(c['uuid'], acquire_ticket=True)
-            lookup.close()
+        try:
+            ticket = _acquire_ticket(s, c)
+        except SourceError:
+            return sf_api.error(404, 'source error')
         db.store_console_ticket(source, uuid, ticket)
 
         token = consoletoken.create_token(source, uuid)
-        vv = VIRTVIEWER_TEMPLATE % {
-            'node': config.PUBLIC_FQDN,
-            'port': config.VDI_INSECURE_PORT,
-            'tls_port': '\ntls-port=%s' % config.VDI_SECURE_PORT,
+        vv = _get_proxy_vv_template() % {
             'token': token['token'],
-            'ca_cert': '\nca=%s' % cacert,
-            'name': '%s via proxy session ID %s' % (c['name'], token['session_id']),
-            'host_subject': host_subject
+            'name': '%s via proxy session ID %s' % (c['name'], token['session_id'])
         }
 
         resp = flask.Response(vv, mimetype='application/x-virt-viewer;charset=UTF-8')
@@ -450,32 +909,175 @@ class ConsolesProxyVirtViewer(sf_api.Resource):
         return resp
 
 
-class ConsolesTerminate(sf_api.Resource):
+class ConsolesProxyVirtViewerBulk(sf_api.Resource):
     @verify_token
-    def get(self, source=None, uuid=None):
-        tokens = []
-        for token in db.get_tokens_by_console(source, uuid):
-            db.expire_token(token['token'])
-            db.remove_session(token['session_id'])
-            db.add_audit_event(
-                token['source'], token['uuid'], token['session_id'],
-                None, None, None, 'Session terminated by request')
-            tokens.append(token['token'])
+    def post(self, consoles=None, output='json'):
+        # Mint proxy virt-viewer files for many consoles at once. consoles is
+        # a list of dictionaries with source and uuid keys.
+        if not consoles or not isinstance(consoles, list):
+            return sf_api.error(400, 'no consoles specified')
+        if len(consoles) > config.BULK_CONSOLE_LIMIT:
+            return sf_api.error(
+                400, 'at most %d consoles may be requested at once'
+                % config.BULK_CONSOLE_LIMIT)
+        if output not in ['json', 'zip']:
+            return sf_api.error(400, 'output must be json or zip')
+
+        for requested in consoles:
+            if not isinstance(requested, dict):
+                return sf_api.error(400, 'consoles must have a source and uuid')
+            for field in ['source', 'uuid']:
+                if not isinstance(requested.get(field), str) or not requested[field]:
+                    return sf_api.error(400, 'consoles must have a source and uuid')
+
+        wanted = {}
+        errors = {}
+        for requested in consoles:
+            key = '%s/%s' % (requested['source'], requested['uuid'])
+
+            s = cache.get_source(requested['source'])
+            if not s:
+                errors[key] = 'source not found'
+                continue
+            wanted[key] = (s, requested['uuid'])
+
+        # Consoles which have not been discovered yet are looked up in their
+        # source, which is a round trip each, so we resolve them concurrently.
+        found = {}
+        resolving = []
+        for key, (s, uuid) in wanted.items():
+            resolving.append((key, TICKET_EXECUTOR.submit(_resolve_console, s, uuid)))
+
+        for key, future in resolving:
+            try:
+                c = future.result()
+            except SourceError:
+                errors[key] = 'source error'
+                continue
+            except Exception as e:
+                LOG.with_fields({'console': key}).warning(
+                    'Failed to resolve console for bulk request: %s' % e)
+                errors[key] = 'failed to resolve console'
+                continue
+            if not c:
+                errors[key] = 'console not found'
+                continue
+
+            # Key results by the console found, so duplicates are only minted once
+            found['%s/%s' % (c['source'], c['uuid'])] = (wanted[key][0], c)
+
+        # Acquire tickets concurrently, as for oVirt each is a round trip to
+        # the engine. The pool is shared between requests so that the per
+        # thread oVirt connections are reused.
+        tickets = {}
+        pending = {}
+        for key, (s, c) in found.items():
+            pending[TICKET_EXECUTOR.submit(_acquire_ticket, s, c)] = key
+
+        for future in futures.as_completed(pending):
+            key = pending[future]
+            try:
+                tickets[key] = future.result()
+            except SourceError:
+                errors[key] = 'source error'
+                del found[key]
+            except Exception as e:
+                LOG.with_fields({'console': key}).warning(
+                    'Failed to acquire ticket for bulk request: %s' % e)
+                errors[key] = 'failed to acquire ticket'
+                del found[key]
+
+        db.store_console_tickets(
+            {found[key][1]['uuid']: tickets[key] for key in found})
+        tokens = consoletoken.create_tokens(
+            [(found[key][1]['source'], found[key][1]['uuid']) for key in found])
+
+        template = _get_proxy_vv_template()
+        results = {}
+        for key, token in zip(found, tokens):
+            c = found[key][1]
+            results[key] = {
+                'name': c['name'],
+                'session_id': token['session_id'],
+                'vv': template % {
+                    'token': token['token'],
+                    'name': '%s via proxy session ID %s' % (c['name'], token['session_id'])
+                }
+            }
 
-        if flask.request.headers.get('Accept', 'text/html').find('text/html') != -1:
-            return flask.redirect('/console', code=302)
+        LOG.info('Providing %d bulk virt-viewer proxy configurations, %d failed'
+                 % (len(results), len(errors)))
 
-        resp = flask.Response(
-            json.dumps(
-                {
-                    'result': 'ok',
-                    'tokens': tokens
-                }, indent=4, sort_keys=True),
-            mimetype='application/json')
+        if output == 'zip':
+            buffer = io.BytesIO()
+            with zipfile.ZipFile(buffer, 'w', compression=zipfile.ZIP_DEFLATED) as z:
+                for key, result in results.items():
+                    z.writestr('%s.vv' % key.replace('/', '-'), result['vv'])
+                if errors:
+                    z.writestr('errors.json', json.dumps(errors, indent=4, sort_keys=True))
+
+            resp = flask.Response(buffer.getvalue(), mimetype='application/zip')
+            resp.headers['Content-Disposition'] = 'attachment; filename=consoles.zip'
+        else:
+            resp = _json_response({
+                'result': 'ok',
+                'consoles': results,
+                'errors': errors
+            })
         resp.status_code = 200
         return resp
 
 
+def _close_local_channels(channels):
+    # Proxies close channels for terminated sessions on their next pass over
+    # the channel table, but we can close the ones on this node right away.
+    # The process name is checked so that we never kill a process which has
+    # reused the pid of a channel which has already exited.
+    for channel in channels:
+        if channel['node'] != config.NODE_NAME:
+            continue
+
+        try:
+            p = psutil.Process(channel['pid'])
+            if not p.name().startswith('kerbside-secure-%s-' % channel['session_id']):
+                continue
+            os.kill(channel['pid'], signal.SIGKILL)
+            LOG.with_fields(channel).info('Closed channel for terminated session')
+        except (psutil.Error, ProcessLookupError, PermissionError) as e:
+            LOG.with_fields(channel).info(
+                'Could not close channel for terminated session: %s' % e)
+
+
+def _terminate_sessions(redirect, **kwargs):
+    tokens, channels = db.terminate_sessions(**kwargs)
+    _close_local_channels(channels)
+
+    if flask.request.headers.get('Accept', 'text/html').find('text/html') != -1:
+        return flask.redirect(redirect, code=302)
+
+    resp = _json_response({
+        'result': 'ok',
+        'tokens': [t['token'] for t in tokens],
+        'sessions': [t['session_id'] for t in tokens]
+    })
+    resp.status_code = 200
+    return resp
+
+
+class ConsolesTerminate(sf_api.Resource):
+    @verify_token
+    def get(self, source=None, uuid=None):
+        return _terminate_sessions('/console', source=source, uuid=uuid)
+
+
+class SourceTerminate(sf_api.Resource):
+    @verify_token
+    def get(self, source=None):
+        if not cache.get_source(source):
+            return sf_api.error(404, 'source not found')
+        return _terminate_sessions('/source', source=source)
+
+
 class Sessions(sf_api.Resource):
     @verify_token
     def get(self):
@@ -484,13 +1086,10 @@ class Sessions(sf_api.Resource):
                 flask.render_template(
                     'sessions.html', sessions=db.get_sessions(),
                     navitems=get_nav_items('Sessions'),
-                    refresh=True, when=datetime.datetime.now()),
+                    live=['session_terminated', 'channel_added', 'channel_removed'], when=datetime.datetime.now()),
                 mimetype='text/html')
         else:
-            resp = flask.Response(
-                json.dumps(db.get_sessions(), indent=4, sort_keys=True,
-                           cls=DateTimeEncoder),
-                mimetype='application/json')
+            resp = _json_dict_response(db.iter_sessions())
         resp.status_code = 200
         return resp
 
@@ -498,40 +1097,69 @@ class Sessions(sf_api.Resource):
 class SessionTerminate(sf_api.Resource):
     @verify_token
     def get(self, session=None):
-        token = db.get_token_by_session_id(session)
-        if not token:
+        if not db.get_token_by_session_id(session):
             return sf_api.error(404, 'session not found')
+        return _terminate_sessions('/session', session_ids=[session])
 
-        db.remove_session(token['session_id'])
-        db.add_audit_event(
-            token['source'], token['uuid'], token['session_id'],
-            None, None, None, 'Session terminated by request')
 
-        if flask.request.headers.get('Accept', 'text/html').find('text/html') != -1:
-            return flask.redirect('/session', code=302)
+class SessionsTerminate(sf_api.Resource):
+    @verify_token
+    def post(self, sessions=None):
+        if not sessions or not isinstance(sessions, list):
+            return sf_api.error(400, 'no sessions specified')
+        if not all(isinstance(session_id, str) for session_id in sessions):
+            return sf_api.error(400, 'sessions must be session id strings')
+        return _terminate_sessions('/session', session_ids=sessions)
 
-        resp = flask.Response(
-            json.dumps(
-                {
-                    'result': 'ok'
-                }, indent=4, sort_keys=True),
-            mimetype='application/json')
+
+class Events(sf_api.Resource):
+    @verify_token
+    def get(self):
+        # A server sent events stream of changes, used by the admin pages to
+        # update themselves in place instead of periodically reloading.
+        def generate():
+            q = changes.subscribe()
+            try:
+                deadline = time.time() + config.CHANGE_FEED_STREAM_DURATION
+                yield 'retry: %d\n\n' % (config.CHANGE_FEED_INTERVAL * 1000)
+                while time.time() < deadline:
+                    try:
+                        event = q.get(timeout=15)
+                        yield 'event: %s\ndata: %s\n\n' % (
+                            event['type'], json.dumps(event))
+                    except queue.Empty:
+                        # A comment keeps idle connections from being closed
+                        yield ': keepalive\n\n'
+            finally:
+                changes.unsubscribe(q)
+
+        resp = flask.Response(flask.stream_with_context(generate()),
+                              mimetype='text/event-stream')
+        resp.headers['Cache-Control'] = 'no-cache'
+        resp.headers['X-Accel-Buffering'] = 'no'
         resp.status_code = 200
         return resp
 
 
 api.add_resource(Root, '/')
 api.add_resource(Auth, '/auth')
+api.add_resource(Ready, '/ready')
 api.add_resource(Consoles, '/console')
 api.add_resource(Console, '/console/<source>/<uuid>')
+api.add_resource(ConsoleRow, '/console/<source>/<uuid>/row')
 api.add_resource(ConsolesAudit, '/console/<source>/<uuid>/audit')
+api.add_resource(ConsolesAuditExport, '/console/<source>/<uuid>/audit/export')
 api.add_resource(ConsolesDirectVirtViewer, '/console/direct/<source>/<uuid>/console.vv')
 api.add_resource(ConsolesProxyVirtViewer, '/console/proxy/<source>/<uuid>/console.vv')
+api.add_resource(ConsolesProxyVirtViewerBulk, '/console/proxy/bulk')
 api.add_resource(ConsolesTerminate, '/console/<source>/<uuid>/terminate')
 api.add_resource(Sessions, '/session')
+api.add_resource(SessionsTerminate, '/session/terminate')
 api.add_resource(SessionTerminate, '/session/<session>/terminate')
+api.add_resource(Events, '/events')
 api.add_resource(Sources, '/source')
 api.add_resource(Source, '/source/<uuid>')
+api.add_resource(SourceTerminate, '/source/<source>/terminate')
 
 
 def run():
@@ -551,6 +1179,23 @@ def run():
         LOG.setLevel(logging.DEBUG)
     LOG.info('REST API starting')
 
+    # Gunicorn workers record their metrics in this directory, and we export
+    # the aggregated values.
+    metrics_dir = os.path.join(config.PID_FILE_LOCATION, 'kerbside-api-metrics')
+    shutil.rmtree(metrics_dir, ignore_errors=True)
+    os.makedirs(metrics_dir)
+    os.environ['PROMETHEUS_MULTIPROC_DIR'] = metrics_dir
+    try:
+        os.environ['KERBSIDE_API_STARTED_DISCOVERY_VERSION'] = str(
+            db.get_version(db.DISCOVERY_VERSION))
+    except Exception as e:
+        LOG.warning('Failed to look up the discovery version, workers will '
+                    'look it up when first asked if they are ready: %s' % e)
+
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry, path=metrics_dir)
+    start_http_server(config.PROMETHEUS_API_METRICS_PORT, registry=registry)
+
     os.makedirs(config.PID_FILE_LOCATION, exist_ok=True)
     command = config.API_COMMAND_LINE % {
         'port': config.API_PORT,
@@ -0,0 +1,174 @@
+# A read-through cache of the console inventory (sources and consoles) for
+# the API workers. Each worker keeps the most recent snapshot in memory and
+# checks the inventory version in the database at most once per TTL. When the
+# version has moved on, the worker looks for a snapshot of the new version on
+# local disk written by another worker before falling back to the database.
+# This means that for each inventory change only one of the API workers on a
+# node should need to load the full inventory from MySQL.
+
+import datetime
+import glob
+import json
+import os
+from shakenfist_utilities import logs
+import stat
+import tempfile
+import time
+
+from .config import config
+from . import db
+from . import util
+
+
+LOG, _ = logs.setup(__name__, **util.configure_logging())
+
+
+SNAPSHOT = None
+LAST_CHECKED = 0
+
+
+def _encode(value):
+    if isinstance(value, datetime.datetime):
+        return {'__datetime__': value.isoformat()}
+    raise TypeError('%s is not JSON serializable' % type(value))
+
+
+def _decode(d):
+    if '__datetime__' in d:
+        return datetime.datetime.fromisoformat(d['__datetime__'])
+    return d
+
+
+def _snapshot_path(version):
+    return os.path.join(config.INVENTORY_CACHE_PATH, 'inventory-%d.json' % version)
+
+
+def _snapshot_directory_is_private():
+    # Snapshots include source credentials, and are trusted when read back,
+    # so we only use a directory which is owned by us and which no one else
+    # can read or write. A directory which someone else created first is
+    # refused rather than adopted.
+    try:
+        os.makedirs(config.INVENTORY_CACHE_PATH, mode=0o700, exist_ok=True)
+        st = os.lstat(config.INVENTORY_CACHE_PATH)
+    except OSError as e:
+        LOG.warning('Failed to create inventory snapshot directory: %s' % e)
+        return False
+
+    if (not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid()
+            or stat.S_IMODE(st.st_mode) != 0o700):
+        LOG.warning('Not using inventory snapshot directory %s as it is not a '
+                    'directory owned by us with mode 0700'
+                    % config.INVENTORY_CACHE_PATH)
+        return False
+    return True
+
+
+def _read_snapshot(version):
+    if not _snapshot_directory_is_private():
+        return None
+
+    try:
+        with open(_snapshot_path(version)) as f:
+            return json.load(f, object_hook=_decode)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_snapshot(snapshot):
+    # Sources include credentials, so the snapshots must only be readable by
+    # us. Snapshots are written to a temporary file and then renamed so that
+    # other workers never see a partial snapshot.
+    if not _snapshot_directory_is_private():
+        return
+
+    try:
+        fd, temp_path = tempfile.mkstemp(dir=config.INVENTORY_CACHE_PATH)
+        os.fchmod(fd, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(snapshot, f, default=_encode)
+        path = _snapshot_path(snapshot['version'])
+        os.replace(temp_path, path)
+
+        for old in glob.glob(os.path.join(config.INVENTORY_CACHE_PATH, 'inventory-*.json')):
+            if old != path:
+                os.unlink(old)
+    except OSError as e:
+        LOG.warning('Failed to write inventory snapshot: %s' % e)
+
+
+def _get_snapshot():
+    global SNAPSHOT
+    global LAST_CHECKED
+
+    if SNAPSHOT and time.time() - LAST_CHECKED < config.INVENTORY_CACHE_TTL:
+        return SNAPSHOT
+
+    # The version is read before the inventory, so a snapshot is never older
+    # than the version it is labelled with.
+    version = db.get_version(db.INVENTORY_VERSION)
+    LAST_CHECKED = time.time()
+    if SNAPSHOT and SNAPSHOT['version'] == version:
+        return SNAPSHOT
+
+    snapshot = _read_snapshot(version)
+    if not snapshot:
+        sources, consoles = db.get_inventory()
+        snapshot = {
+            'version': version,
+            'sources': sources,
+            'consoles': consoles
+        }
+        _write_snapshot(snapshot)
+
+    snapshot['sources_by_name'] = {}
+    for s in snapshot['sources']:
+        snapshot['sources_by_name'][s['name']] = s
+    snapshot['consoles_by_uuid'] = {}
+    for c in snapshot['consoles']:
+        snapshot['consoles_by_uuid'][c['uuid']] = c
+
+    SNAPSHOT = snapshot
+    return SNAPSHOT
+
+
+def get_inventory_version():
+    if config.INVENTORY_CACHE_TTL < 1:
+        return db.get_version(db.INVENTORY_VERSION)
+    return _get_snapshot()['version']
+
+
+def get_sources():
+    if config.INVENTORY_CACHE_TTL < 1:
+        return db.get_sources()
+
+    out = []
+    for s in _get_snapshot()['sources']:
+        if not s['deleted']:
+            out.append(dict(s))
+    return out
+
+
+def get_source(name):
+    if config.INVENTORY_CACHE_TTL < 1:
+        return db.get_source(name)
+
+    s = _get_snapshot()['sources_by_name'].get(name)
+    if s:
+        return dict(s)
+    return None
+
+
+def get_console(source, uuid):
+    # Like db.get_console(), this returns the console without session details,
+    # and also without the hypervisor ticket.
+    if config.INVENTORY_CACHE_TTL < 1:
+        c = db.get_console(source, uuid)
+        if c:
+            del c['ticket']
+        return c
+
+    c = _get_snapshot()['consoles_by_uuid'].get(uuid)
+    if c:
+        return dict(c)
+    return None
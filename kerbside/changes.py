@@ -0,0 +1,193 @@
+# A change feed for the admin pages. Each API worker runs at most one poller
+# thread, and only while a browser is subscribed. The poller watches the
+# inventory, sources and channel versions and the audit log, and fans out
+# small change events to every subscriber. This means that however many admin
+# pages are open, each worker only makes a few cheap queries per interval,
+# and pages only re-render when something they display has actually changed.
+
+import datetime
+import queue
+from shakenfist_utilities import logs
+import threading
+import time
+
+from .config import config
+from . import db
+from . import util
+
+
+LOG, _ = logs.setup(__name__, **util.configure_logging())
+
+
+# Audit messages which map to more specific change events
+AUDIT_EVENT_TYPES = {
+    'Created authentication token for session.': 'token_created',
+    'Discovered new console': 'console_discovered',
+    'Console no longer available': 'console_removed',
+    'Session terminated by request': 'session_terminated'
+}
+
+SUBSCRIBERS = []
+SUBSCRIBERS_LOCK = threading.Lock()
+POLLER = None
+
+
+def _channel_key(channel):
+    return '%s/%d' % (channel['node'], channel['pid'])
+
+
+def _audit_key(event):
+    return (event['timestamp'], event['source'], event['uuid'])
+
+
+def _publish(event):
+    with SUBSCRIBERS_LOCK:
+        subscribers = list(SUBSCRIBERS)
+    for q in subscribers:
+        try:
+            q.put_nowait(event)
+        except queue.Full:
+            # A subscriber which is not keeping up is told to reload instead
+            # of being sent every individual change.
+            try:
+                while True:
+                    q.get_nowait()
+            except queue.Empty:
+                pass
+            q.put_nowait({'type': 'resync'})
+
+
+def _publish_audit_events(cursor, seen):
+    # Audit timestamps are assigned when a row is inserted, not when it is
+    # committed, so an event can become visible after newer ones. Events
+    # within the grace period of the newest one are therefore read again on
+    # the next poll, and the ones already published are skipped. The cursor
+    # only moves past events once they are older than the grace period, or
+    # when a full batch means we are behind and must move on regardless.
+    limit = 1000
+    events = db.get_recent_audit_events(cursor, limit=limit)
+    for e in events:
+        key = _audit_key(e)
+        if key in seen:
+            continue
+        seen.add(key)
+        _publish({
+            'type': AUDIT_EVENT_TYPES.get(e['message'], 'audit'),
+            'source': e['source'],
+            'uuid': e['uuid'],
+            'session_id': e['session_id'],
+            'message': e['message']
+        })
+
+    if not events:
+        return cursor
+    if len(events) == limit:
+        cursor = _audit_key(events[-1])
+    else:
+        settled = events[-1]['timestamp'] - datetime.timedelta(
+            seconds=config.CHANGE_FEED_AUDIT_GRACE)
+        for e in events:
+            if e['timestamp'] > settled:
+                break
+            cursor = _audit_key(e)
+
+    for key in list(seen):
+        if cursor and key <= cursor:
+            seen.discard(key)
+    return cursor
+
+
+def _publish_channel_changes(previous, current):
+    for key in current.keys() - previous.keys():
+        c = current[key]
+        _publish({
+            'type': 'channel_added',
+            'node': c['node'],
+            'pid': c['pid'],
+            'session_id': c['session_id'],
+            'source': c['source'],
+            'uuid': c['uuid']
+        })
+    for key in previous.keys() - current.keys():
+        c = previous[key]
+        _publish({
+            'type': 'channel_removed',
+            'node': c['node'],
+            'pid': c['pid'],
+            'session_id': c['session_id'],
+            'source': c['source'],
+            'uuid': c['uuid']
+        })
+
+
+def _poll():
+    global POLLER
+
+    versions = None
+    audit_cursor = None
+    audit_seen = set()
+    channels = None
+
+    while True:
+        with SUBSCRIBERS_LOCK:
+            if not SUBSCRIBERS:
+                POLLER = None
+                return
+
+        try:
+            current_versions = db.get_versions(
+                [db.INVENTORY_VERSION, db.SOURCES_VERSION, db.CHANNELS_VERSION])
+
+            if versions is None:
+                # Only events which happen after we subscribe are interesting
+                audit_cursor = db.get_latest_audit_cursor()
+            else:
+                if (current_versions[db.INVENTORY_VERSION] !=
+                        versions[db.INVENTORY_VERSION]):
+                    _publish({
+                        'type': 'inventory_changed',
+                        'version': current_versions[db.INVENTORY_VERSION]
+                    })
+                if (current_versions[db.SOURCES_VERSION] !=
+                        versions[db.SOURCES_VERSION]):
+                    _publish({
+                        'type': 'source_changed',
+                        'version': current_versions[db.SOURCES_VERSION]
+                    })
+                audit_cursor = _publish_audit_events(audit_cursor, audit_seen)
+
+            # The channel table is only read when a proxy has changed it
+            if (channels is None or current_versions[db.CHANNELS_VERSION] !=
+                    versions[db.CHANNELS_VERSION]):
+                current = {}
+                for c in db.get_channels():
+                    current[_channel_key(c)] = c
+                if channels is not None:
+                    _publish_channel_changes(channels, current)
+                channels = current
+
+            versions = current_versions
+
+        except Exception as e:
+            LOG.warning('Change feed poll failed: %s' % e)
+
+        time.sleep(config.CHANGE_FEED_INTERVAL)
+
+
+def subscribe():
+    global POLLER
+
+    q = queue.Queue(maxsize=100)
+    with SUBSCRIBERS_LOCK:
+        SUBSCRIBERS.append(q)
+        if not POLLER:
+            POLLER = threading.Thread(target=_poll, daemon=True,
+                                      name='kerbside-change-feed')
+            POLLER.start()
+    return q
+
+
+def unsubscribe(q):
+    with SUBSCRIBERS_LOCK:
+        if q in SUBSCRIBERS:
+            SUBSCRIBERS.remove(q)
@@ -16,29 +16,39 @@ class TokenFailure(Exception):
     ...
 
 
+def _generate_token(source, uuid):
+    # Create a random token id. The maximum length of SPICE passwords doesn't
+    # seem to be documented anywhere. The field is 128 bytes in the packet,
+    # but you can't just use 128 ASCII characters here.
+    alphabet = string.ascii_letters + string.digits
+    now = int(time.time())
+    return {
+        'token': ''.join(secrets.choice(alphabet) for i in range(48)),
+        'session_id': ''.join(secrets.choice(alphabet) for i in range(12)),
+        'source': source,
+        'uuid': uuid,
+        'created': now,
+        'expires': now + (config.CONSOLE_TOKEN_DURATION * 60)
+    }
+
+
 def create_token(source, uuid):
     attempts = 0
 
     while attempts < 5:
         try:
-            # Create a random token id. The maximum length of SPICE passwords
-            # doesn't seem to be documented anywhere. The field is 128 bytes in
-            # the packet, but you can't just use 128 ASCII characters here.
-            alphabet = string.ascii_letters + string.digits
-            token = ''.join(secrets.choice(alphabet) for i in range(48))
-            session_id = ''.join(secrets.choice(alphabet) for i in range(12))
-            now = int(time.time())
-            expiry = now + (config.CONSOLE_TOKEN_DURATION * 60)
+            t = _generate_token(source, uuid)
 
             # Store the token and return
-            db_token = db.add_token(token, session_id, source, uuid, now, expiry)
+            db_token = db.add_token(t['token'], t['session_id'], source, uuid,
+                                    t['created'], t['expires'])
             LOG.with_fields({
                 'source': source,
                 'uuid': uuid,
-                'session_id': session_id
+                'session_id': t['session_id']
             }).info('Created authentication token')
             db.add_audit_event(
-                source, uuid, session_id, None, None, None,
+                source, uuid, t['session_id'], None, None, None,
                 'Created authentication token for session.')
 
             return db_token
@@ -47,3 +57,22 @@ def create_token(source, uuid):
             attempts += 1
 
     raise TokenFailure('Failed to create token after repeated attempts')
+
+
+def create_tokens(consoles):
+    # Create a token for each of a list of (source, uuid) tuples, with a
+    # single database transaction.
+    attempts = 0
+
+    while attempts < 5:
+        try:
+            db_tokens = db.add_tokens(
+                [_generate_token(source, uuid) for source, uuid in consoles],
+                'Created authentication token for session.')
+            LOG.info('Created %d authentication tokens' % len(db_tokens))
+            return db_tokens
+
+        except db.ReusedToken:
+            attempts += 1
+
+    raise TokenFailure('Failed to create tokens after repeated attempts')
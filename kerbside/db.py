@@ -1,10 +1,13 @@
 from collections import defaultdict
 import datetime
+import hashlib
+import json
 import time
 
 from sqlalchemy import create_engine, text
-from sqlalchemy import Boolean, Column, DateTime, Integer, String, Text
-from sqlalchemy import desc
+from sqlalchemy import exc as sqlalchemy_exc
+from sqlalchemy import BigInteger, Boolean, Column, DateTime, Integer, String, Text
+from sqlalchemy import and_, desc, func, insert, or_, tuple_, update
 from sqlalchemy.dialects.mysql import DATETIME
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import exc, Session
@@ -21,10 +24,22 @@ LOG, _ = logs.setup(__name__, **util.configure_logging())
 Base = declarative_base()
 ENGINE = create_engine(config.SQL_URL, pool_pre_ping=True, pool_recycle=300)
 
+# Heavy read only queries for listings and audit history can optionally be sent
+# to a read replica, so that they cannot slow down the writes and token lookups
+# which console connections depend on. Anything which needs to see its own
+# writes, or which labels data with a version, must use ENGINE.
+if config.SQL_READ_URL:
+    READ_ENGINE = create_engine(config.SQL_READ_URL, pool_pre_ping=True,
+                                pool_recycle=300)
+else:
+    READ_ENGINE = ENGINE
+
 
 def reset_engine():
     # Force a new SQL engine because the caller is making a new process.
     ENGINE.dispose()
+    if READ_ENGINE is not ENGINE:
+        READ_ENGINE.dispose()
 
 
 class ReusedToken(Exception):
@@ -39,6 +54,131 @@ class UnknownChannel(Exception):
     ...
 
 
+# Named counters which are incremented whenever the data they describe changes,
+# so that readers can cheaply tell if cached copies are still current. The
+# "inventory" version covers sources and consoles. The "discovery" version is
+# incremented each time every configured source has been polled. The
+# "channels" version covers proxy channels, and the "sources" version covers
+# source state which does not affect the inventory, such as circuit breakers.
+INVENTORY_VERSION = 'inventory'
+DISCOVERY_VERSION = 'discovery'
+CHANNELS_VERSION = 'channels'
+SOURCES_VERSION = 'sources'
+
+
+class Version(Base):
+    __tablename__ = 'versions'
+
+    name = Column(String, primary_key=True)
+    version = Column(BigInteger)
+    updated = Column(DateTime)
+
+    def __init__(self, name, version, updated):
+        self.name = name
+        self.version = version
+        self.updated = updated
+
+
+def _bump_version(session, name):
+    # This is called by writers before they commit, so that the new version is
+    # only visible alongside the change it describes.
+    updated = session.query(Version).\
+        filter(Version.name == name).\
+        update({
+            Version.version: Version.version + 1,
+            Version.updated: datetime.datetime.now()
+            }, synchronize_session=False)
+    if not updated:
+        session.add(Version(name, 1, datetime.datetime.now()))
+
+
+def bump_version(name):
+    with Session(ENGINE) as session:
+        _bump_version(session, name)
+        session.commit()
+
+
+def get_version_updated(name):
+    with Session(ENGINE) as session:
+        v = session.query(Version).filter(Version.name == name).one_or_none()
+        if not v:
+            return None
+        return v.updated
+
+
+def get_version(name):
+    with Session(ENGINE) as session:
+        v = session.query(Version).filter(Version.name == name).one_or_none()
+        if not v:
+            return 0
+        return v.version
+
+
+def get_versions(names):
+    out = dict.fromkeys(names, 0)
+    with Session(ENGINE) as session:
+        for v in session.query(Version).filter(Version.name.in_(names)).all():
+            out[v.name] = v.version
+    return out
+
+
+class Lease(Base):
+    __tablename__ = 'leases'
+
+    name = Column(String, primary_key=True)
+    holder = Column(String)
+    expires = Column(DateTime)
+
+    def __init__(self, name, holder, expires):
+        self.name = name
+        self.holder = holder
+        self.expires = expires
+
+
+def acquire_lease(name, holder, duration):
+    # Take or renew a named lease, returning True if holder now holds it. The
+    # lease is taken with a single conditional UPDATE, so only one holder can
+    # win a race for an expired lease. Lease expiry relies on node clocks
+    # being reasonably in sync.
+    now = datetime.datetime.now()
+    expires = now + datetime.timedelta(seconds=duration)
+    with Session(ENGINE) as session:
+        updated = session.query(Lease).\
+            filter(Lease.name == name).\
+            filter(or_(Lease.holder == holder,
+                       Lease.holder.is_(None),
+                       Lease.expires < now)).\
+            update({
+                Lease.holder: holder,
+                Lease.expires: expires
+                }, synchronize_session=False)
+        if updated:
+            session.commit()
+            return True
+
+        if session.query(Lease).filter(Lease.name == name).one_or_none():
+            return False
+
+        try:
+            session.add(Lease(name, holder, expires))
+            session.commit()
+            return True
+        except sqlalchemy_exc.IntegrityError:
+            return False
+
+
+def release_lease(name, holder):
+    with Session(ENGINE) as session:
+        session.query(Lease).\
+            filter(Lease.name == name).\
+            filter(Lease.holder == holder).\
+            update({
+                Lease.holder: None,
+                Lease.expires: None
+                }, synchronize_session=False)
+        session.commit()
+
+
 class Source(Base):
     __tablename__ = 'sources'
 
@@ -59,6 +199,11 @@ class Source(Base):
     project_domain_id = Column(String)
     flavor = Column(String)
 
+    # Circuit breaker state, maintained by discovery
+    breaker_state = Column(String)
+    breaker_failures = Column(Integer)
+    breaker_retry_at = Column(DateTime)
+
     def __init__(self, name, type, last_seen, seen_by, errored, url, ca_cert,
                  username, password, project_name, user_domain_id,
                  project_domain_id, flavor, deleted):
@@ -92,7 +237,10 @@ class Source(Base):
             'user_domain_id': self.user_domain_id,
             'project_domain_id': self.project_domain_id,
             'flavor': self.flavor,
-            'deleted': self.deleted
+            'deleted': self.deleted,
+            'breaker_state': self.breaker_state or 'closed',
+            'breaker_failures': self.breaker_failures or 0,
+            'breaker_retry_at': self.breaker_retry_at
         }
 
 
@@ -124,12 +272,41 @@ def add_source(name, type, url, username, password, project_name=None,
                             flavor, False)
             session.add(source)
         finally:
+            _bump_version(session, INVENTORY_VERSION)
             session.commit()
 
 
+def set_source_breaker_state(name, state, failures, retry_at):
+    # Breaker state changes do not change any console, so this deliberately
+    # bumps the sources version rather than the inventory version. Readers
+    # which want current breaker state use get_source_breaker_states() instead
+    # of a cached inventory.
+    with Session(ENGINE) as session:
+        session.execute(
+            update(Source).
+            where(Source.name == name).
+            values(breaker_state=state, breaker_failures=failures,
+                   breaker_retry_at=retry_at))
+        _bump_version(session, SOURCES_VERSION)
+        session.commit()
+
+
+def get_source_breaker_states():
+    out = {}
+    with Session(READ_ENGINE) as session:
+        for row in session.query(Source.name, Source.breaker_state,
+                                 Source.breaker_failures, Source.breaker_retry_at):
+            out[row.name] = {
+                'breaker_state': row.breaker_state or 'closed',
+                'breaker_failures': row.breaker_failures or 0,
+                'breaker_retry_at': row.breaker_retry_at
+            }
+    return out
+
+
 def get_sources():
     out = []
-    with Session(ENGINE) as session:
+    with Session(READ_ENGINE) as session:
         try:
             for source in session.query(Source).\
                     filter(Source.deleted == False).\
@@ -141,6 +318,22 @@ def get_sources():
     return out
 
 
+def get_inventory():
+    # Return all sources (including deleted ones) and consoles, for callers
+    # which cache the inventory. Console tickets are not included as they
+    # change outside of the inventory version.
+    sources = []
+    consoles = []
+    with Session(ENGINE) as session:
+        for source in session.query(Source).order_by(Source.name).all():
+            sources.append(source.export())
+        for console in session.query(Console).order_by(Console.name).all():
+            c = console.export()
+            del c['ticket']
+            consoles.append(c)
+    return sources, consoles
+
+
 def get_source(name):
     with Session(ENGINE) as session:
         try:
@@ -153,7 +346,9 @@ def get_source(name):
 def set_source_error_state(name, state):
     with Session(ENGINE) as session:
         source = session.query(Source).filter(Source.name == name).one()
-        source.errored = state
+        if source.errored != state:
+            source.errored = state
+            _bump_version(session, INVENTORY_VERSION)
         session.commit()
 
 
@@ -161,6 +356,7 @@ def delete_source(name):
     with Session(ENGINE) as session:
         source = session.query(Source).filter(Source.name == name).one()
         source.deleted = True
+        _bump_version(session, INVENTORY_VERSION)
         session.commit()
 
 
@@ -206,22 +402,50 @@ class Console(Base):
         }
 
 
+# The console fields which sources discover, and which are compared to decide
+# if a console has changed.
+CONSOLE_FIELDS = ['hypervisor', 'hypervisor_ip', 'insecure_port', 'secure_port',
+                  'name', 'host_subject']
+
+
+def console_digest(console):
+    return hashlib.sha256(
+        json.dumps([console.get(f) for f in CONSOLE_FIELDS]).encode()).hexdigest()
+
+
+def get_console_digests(source):
+    # Return a digest of the discovered fields of each console in a source,
+    # keyed by uuid. This avoids loading tokens, tickets and audit history
+    # when all the caller wants is to know what has changed.
+    digests = {}
+    with Session(ENGINE) as session:
+        for row in session.query(
+                Console.uuid, *[getattr(Console, f) for f in CONSOLE_FIELDS]).\
+                filter(Console.source == source):
+            digests[row.uuid] = console_digest(row._asdict())
+    return digests
+
+
 def add_console(source=None, uuid=None, hypervisor=None, hypervisor_ip=None,
                 insecure_port=None, secure_port=None, name=None, host_subject=None,
                 ticket=None, **kwargs):
     with Session(ENGINE) as session:
         try:
             console = session.query(Console).filter(Console.uuid == uuid).one()
-            console.hypervisor = hypervisor
-            console.hypervisor_ip = hypervisor_ip
-            console.insecure_port = insecure_port
-            console.secure_port = secure_port
-            console.name = name
-            console.host_subject = host_subject
+            changed = False
+            for field, value in zip(CONSOLE_FIELDS,
+                                    [hypervisor, hypervisor_ip, insecure_port,
+                                     secure_port, name, host_subject]):
+                if getattr(console, field) != value:
+                    setattr(console, field, value)
+                    changed = True
+            if changed:
+                _bump_version(session, INVENTORY_VERSION)
         except exc.NoResultFound:
             console = Console(uuid, source, hypervisor, hypervisor_ip, insecure_port,
                               secure_port, name, host_subject, ticket)
             session.add(console)
+            _bump_version(session, INVENTORY_VERSION)
             return True
         finally:
             session.commit()
@@ -229,52 +453,138 @@ def add_console(source=None, uuid=None, hypervisor=None, hypervisor_ip=None,
     return False
 
 
-def get_consoles(include_audit=True):
-    sessions = defaultdict(list)
+def get_consoles(include_audit=True, source=None, name_prefix=None,
+                 hypervisor=None, marker=None, limit=None, uuid=None):
+    # Consoles are ordered by (name, uuid). To fetch the next page of results,
+    # pass the (name, uuid) of the last console returned as the marker.
     out = []
     now = time.time()
 
-    with Session(ENGINE) as session:
+    with Session(READ_ENGINE) as session:
         try:
-            for channel in session.query(ProxyChannel).all():
-                sessions[channel.session_id].append((channel.node, channel.pid))
-
-            for console in session.query(Console).order_by(Console.name).all():
+            query = session.query(Console)
+            if source:
+                query = query.filter(Console.source == source)
+            if uuid:
+                query = query.filter(Console.uuid == uuid)
+            if name_prefix:
+                query = query.filter(Console.name.startswith(name_prefix, autoescape=True))
+            if hypervisor:
+                query = query.filter(or_(Console.hypervisor == hypervisor,
+                                         Console.hypervisor_ip == hypervisor))
+            if marker:
+                query = query.filter(or_(
+                    Console.name > marker[0],
+                    and_(Console.name == marker[0], Console.uuid > marker[1])))
+            query = query.order_by(Console.name, Console.uuid)
+            if limit:
+                query = query.limit(limit)
+
+            consoles = query.all()
+            for console in consoles:
                 c = console.export()
                 c['sessions'] = []
                 c['token_count'] = 0
+                out.append(c)
 
+            # Fetch the tokens for all of these consoles at once, and then the
+            # channels for only those tokens' sessions, so that the cost of
+            # each page does not grow with the whole channel table.
+            by_uuid = {}
+            for c in out:
+                by_uuid[c['uuid']] = c
+            tokens = []
+            if by_uuid:
                 for token in session.query(ConsoleToken).\
-                        filter(ConsoleToken.source == c['source']).\
-                        filter(ConsoleToken.uuid == c['uuid']).\
+                        filter(ConsoleToken.uuid.in_(list(by_uuid.keys()))).\
                         all():
-                    if token.expires > now:
-                        c['token_count'] += 1
-                    if token.session_id in sessions:
-                        c['sessions'].append(token.session_id)
+                    if token.source == by_uuid[token.uuid]['source']:
+                        tokens.append(token)
+
+            sessions = set()
+            session_ids = list(set(token.session_id for token in tokens))
+            if session_ids:
+                for row in session.query(ProxyChannel.session_id).\
+                        filter(ProxyChannel.session_id.in_(session_ids)).\
+                        distinct():
+                    sessions.add(row.session_id)
+
+            for token in tokens:
+                c = by_uuid[token.uuid]
+                if token.expires > now:
+                    c['token_count'] += 1
+                if token.session_id in sessions:
+                    c['sessions'].append(token.session_id)
 
+            for c in out:
                 c['audit'] = []
                 if include_audit:
                     events_by_timestamp = {}
-                    with Session(ENGINE) as subsession:
-                        for audit in subsession.query(AuditEvent).\
-                                filter(AuditEvent.source == c['source']).\
-                                filter(AuditEvent.uuid == c['uuid']).\
-                                order_by(desc(AuditEvent.timestamp)).\
-                                limit(20).\
-                                all():
-                            events_by_timestamp[audit.timestamp] = audit.export()
+                    for audit in session.query(AuditEvent).\
+                            filter(AuditEvent.source == c['source']).\
+                            filter(AuditEvent.uuid == c['uuid']).\
+                            order_by(desc(AuditEvent.timestamp)).\
+                            limit(20).\
+                            all():
+                        events_by_timestamp[audit.timestamp] = audit.export()
                     for timestamp in sorted(events_by_timestamp):
                         c['audit'].append(events_by_timestamp[timestamp])
 
-                out.append(c)
-
         except exc.NoResultFound:
             ...
 
     return out
 
 
+def iter_consoles(include_audit=False, source=None, name_prefix=None,
+                  hypervisor=None, batch_size=500):
+    # Yield consoles in the same order as get_consoles(), fetching them in
+    # batches so that callers can stream large inventories.
+    marker = None
+    while True:
+        batch = get_consoles(
+            include_audit=include_audit, source=source, name_prefix=name_prefix,
+            hypervisor=hypervisor, marker=marker, limit=batch_size)
+        for c in batch:
+            yield c
+
+        if len(batch) < batch_size:
+            return
+        marker = (batch[-1]['name'], batch[-1]['uuid'])
+
+
+def get_listing_state(include_sessions=True):
+    # A cheap summary of everything which affects console and session
+    # listings, used to answer conditional requests without building the
+    # listing. This is read from the same engine as the listings themselves,
+    # so that a lagging replica never returns stale data under a current
+    # ETag. Listings without session details only depend on the inventory.
+    now = int(time.time())
+    with Session(READ_ENGINE) as session:
+        v = session.query(Version).\
+            filter(Version.name == INVENTORY_VERSION).\
+            one_or_none()
+        if not include_sessions:
+            return {'inventory_version': v.version if v else 0}
+
+        tokens = session.query(func.count(), func.max(ConsoleToken.created)).\
+            filter(ConsoleToken.expires > now).\
+            one()
+        all_tokens = session.query(func.count()).select_from(ConsoleToken).scalar()
+        channels = session.query(func.count(), func.max(ProxyChannel.created)).one()
+        last_audit = session.query(func.max(AuditEvent.timestamp)).scalar()
+
+    return {
+        'inventory_version': v.version if v else 0,
+        'active_tokens': tokens[0],
+        'last_token_created': tokens[1],
+        'tokens': all_tokens,
+        'channels': channels[0],
+        'last_channel_created': channels[1],
+        'last_audit_event': last_audit
+    }
+
+
 def get_console(source, uuid, detailed=False):
     now = time.time()
 
@@ -315,11 +625,25 @@ def store_console_ticket(source, uuid, ticket):
         session.commit()
 
 
+def store_console_tickets(tickets):
+    # Store many tickets at once, tickets is a dictionary of console uuid to
+    # ticket. This is a single executemany UPDATE by primary key.
+    if not tickets:
+        return
+
+    with Session(ENGINE) as session:
+        session.execute(
+            update(Console),
+            [{'uuid': uuid, 'ticket': ticket} for uuid, ticket in tickets.items()])
+        session.commit()
+
+
 def remove_console(source=None, uuid=None, **kwargs):
     with Session(ENGINE) as session:
         try:
             for c in session.query(Console).filter(Console.uuid == uuid).all():
                 session.delete(c)
+                _bump_version(session, INVENTORY_VERSION)
         except exc.NoResultFound:
             return None
         finally:
@@ -368,18 +692,35 @@ def add_token(token, session_id, source, uuid, created, expires):
             return token.export()
 
 
-def get_tokens_by_console(source, uuid):
-    out = []
+def add_tokens(tokens, message):
+    # Add many tokens, and an audit event for each, in a single transaction
+    # with multi row inserts. Each token is a dictionary with the same fields
+    # as the arguments to add_token().
+    if not tokens:
+        return []
+
     with Session(ENGINE) as session:
-        try:
-            for c in session.query(ConsoleToken).\
-                    filter(ConsoleToken.source == source).\
-                    filter(ConsoleToken.uuid == uuid).\
-                    all():
-                out.append(c.export())
-        except exc.NoResultFound:
-            ...
-    return out
+        reused = session.query(ConsoleToken.token).\
+            filter(ConsoleToken.token.in_([t['token'] for t in tokens])).\
+            first()
+        if reused:
+            raise ReusedToken('We already have token %s' % reused[0])
+
+        session.execute(insert(ConsoleToken), tokens)
+        session.execute(
+            insert(AuditEvent),
+            [
+                {
+                    'source': t['source'],
+                    'uuid': t['uuid'],
+                    'session_id': t['session_id'],
+                    'message': message
+                } for t in tokens
+            ])
+        session.commit()
+
+    LOG.info('Audit: %s (%d times)' % (message, len(tokens)))
+    return [dict(t) for t in tokens]
 
 
 def get_token_by_token(token):
@@ -405,29 +746,64 @@ def get_token_by_session_id(session_id):
             return None
 
 
-def expire_token(token):
-    with Session(ENGINE) as session:
-        try:
-            for c in session.query(ConsoleToken).\
-                    filter(ConsoleToken.token == token).\
-                    all():
-                c.expires = time.time()
-        except exc.NoResultFound:
-            return None
-        finally:
-            session.commit()
-
+def terminate_sessions(session_ids=None, source=None, uuid=None,
+                       message='Session terminated by request'):
+    # Terminate a list of sessions, all sessions for a console, or all
+    # sessions for a source. The tokens and proxy channels for the sessions
+    # are removed and audit events written in a single transaction. Proxies
+    # notice that the channels are gone and close them, but we return the
+    # removed channels so that the caller can close local ones immediately.
+    if session_ids is None and not source:
+        raise ValueError('terminate_sessions requires sessions or a source')
 
-def remove_session(session_id):
     with Session(ENGINE) as session:
-        try:
-            c = session.query(ConsoleToken).\
-                filter(ConsoleToken.session_id == session_id).\
-                one()
-            session.delete(c)
-            session.commit()
-        except exc.NoResultFound:
-            return None
+        query = session.query(ConsoleToken)
+        if session_ids is not None:
+            query = query.filter(ConsoleToken.session_id.in_(session_ids))
+        if source:
+            query = query.filter(ConsoleToken.source == source)
+        if uuid:
+            query = query.filter(ConsoleToken.uuid == uuid)
+        tokens = [t.export() for t in query.all()]
+        if not tokens:
+            return [], []
+
+        terminated = [t['session_id'] for t in tokens]
+        channels = [c.export() for c in session.query(ProxyChannel).
+                    filter(ProxyChannel.session_id.in_(terminated)).all()]
+
+        if channels:
+            session.query(ProxyChannel).\
+                filter(ProxyChannel.session_id.in_(terminated)).\
+                delete(synchronize_session=False)
+            _bump_version(session, CHANNELS_VERSION)
+        session.query(ConsoleToken).\
+            filter(ConsoleToken.session_id.in_(terminated)).\
+            delete(synchronize_session=False)
+
+        # Audit events are keyed by console and timestamp, and the database
+        # default timestamp is the same for every row of a statement. A
+        # console can have many sessions, so each statement includes at most
+        # one session per console.
+        by_console = defaultdict(list)
+        for t in tokens:
+            by_console[(t['source'], t['uuid'])].append(t)
+        while by_console:
+            session.execute(
+                insert(AuditEvent),
+                [
+                    {
+                        'source': console_tokens[0]['source'],
+                        'uuid': console_tokens[0]['uuid'],
+                        'session_id': console_tokens.pop(0)['session_id'],
+                        'message': message
+                    } for console_tokens in by_console.values()
+                ])
+            by_console = {k: v for k, v in by_console.items() if v}
+        session.commit()
+
+    LOG.info('Audit: %s (%d times)' % (message, len(tokens)))
+    return tokens, channels
 
 
 def reap_expired_tokens():
@@ -491,38 +867,40 @@ class ProxyChannel(Base):
         }
 
 
-def record_channel_info(node, pid, client_ip=None, client_port=None,
+def record_channel_info(node, pid, created=None, client_ip=None, client_port=None,
                         connection_id=None, channel_type=None, channel_id=None,
                         session_id=None):
-    with Session(ENGINE) as session:
-        try:
-            channel = session.query(ProxyChannel).\
-                filter(ProxyChannel.node == node).\
-                filter(ProxyChannel.pid == pid).\
-                one()
-
-        except exc.NoResultFound:
-            channel = ProxyChannel(node, pid, datetime.datetime.now())
-            session.add(channel)
+    # Proxy workers accumulate channel state in memory while the handshake
+    # progresses and then record it here once, so this is a single merge
+    # rather than a read-modify-write per handshake step.
+    if not created:
+        created = datetime.datetime.now()
 
-        for arg in ['client_ip', 'client_port', 'connection_id',
-                    'channel_type', 'channel_id', 'session_id']:
-            if locals()[arg]:
-                setattr(channel, arg, locals()[arg])
+    with Session(ENGINE) as session:
+        channel = ProxyChannel(node, pid, created)
+        channel.client_ip = client_ip
+        channel.client_port = client_port
+        channel.connection_id = connection_id
+        channel.channel_type = channel_type
+        channel.channel_id = channel_id
+        channel.session_id = session_id
+        session.merge(channel)
+        _bump_version(session, CHANNELS_VERSION)
         session.commit()
 
 
-def remove_proxy_channel(node, pid):
+def remove_proxy_channels(node, pids):
+    if not pids:
+        return
+
     with Session(ENGINE) as session:
-        try:
-            for c in list(session.query(ProxyChannel).
-                          filter(ProxyChannel.node == node).
-                          filter(ProxyChannel.pid == pid).
-                          all()):
-                session.delete(c)
-            session.commit()
-        except exc.NoResultFound:
-            return None
+        removed = session.query(ProxyChannel).\
+            filter(ProxyChannel.node == node).\
+            filter(ProxyChannel.pid.in_(pids)).\
+            delete(synchronize_session=False)
+        if removed:
+            _bump_version(session, CHANNELS_VERSION)
+        session.commit()
 
 
 def get_node_channels(node):
@@ -538,52 +916,71 @@ def get_node_channels(node):
     return out
 
 
+def get_channels():
+    # Channels are returned with the console their session is for, where the
+    # session's token still exists.
+    out = []
+    with Session(READ_ENGINE) as session:
+        for c, source, uuid in session.query(
+                ProxyChannel, ConsoleToken.source, ConsoleToken.uuid).\
+                outerjoin(ConsoleToken,
+                          ConsoleToken.session_id == ProxyChannel.session_id).\
+                all():
+            channel = c.export()
+            channel['source'] = source
+            channel['uuid'] = uuid
+            out.append(channel)
+    return out
+
+
 def remove_node_channels(node):
     with Session(ENGINE) as session:
-        try:
-            for c in session.query(ProxyChannel).\
-                    filter(ProxyChannel.node == node).\
-                    all():
-                session.delete(c)
-        except exc.NoResultFound:
-            return None
-        finally:
-            session.commit()
-
+        removed = session.query(ProxyChannel).\
+            filter(ProxyChannel.node == node).\
+            delete(synchronize_session=False)
+        if removed:
+            _bump_version(session, CHANNELS_VERSION)
+        session.commit()
 
-def get_sessions():
-    out = {}
 
-    with Session(ENGINE) as session:
+def iter_sessions():
+    # Yield (session_id, session) pairs for all sessions with open channels,
+    # ordered by session id. Channels are read in session id order so that
+    # each session can be yielded as soon as all of its channels are seen.
+    with Session(READ_ENGINE) as session:
         session_consoles = {}
-        for ct in session.query(ConsoleToken).all():
-            session_consoles[ct.session_id] = {
-                    'source': ct.source,
-                    'uuid': ct.uuid
-                }
-
-        for session_id in session_consoles:
-            c = session.query(Console).\
-                filter(Console.source == session_consoles[session_id]['source']).\
-                filter(Console.uuid == session_consoles[session_id]['uuid']).\
-                one()
-            session_consoles[session_id]['name'] = c.name
+        for session_id, source, uuid, name in session.query(
+                ConsoleToken.session_id, ConsoleToken.source, ConsoleToken.uuid,
+                Console.name).\
+                outerjoin(Console, and_(Console.source == ConsoleToken.source,
+                                        Console.uuid == ConsoleToken.uuid)).\
+                all():
+            session_consoles[session_id] = {
+                'source': source,
+                'uuid': uuid,
+                'name': name
+            }
+
+        current_id = None
+        current = None
+        for channel in session.query(ProxyChannel).\
+                filter(ProxyChannel.session_id != None).\
+                order_by(ProxyChannel.session_id).\
+                yield_per(500):                                     # noqa: E711
+            if channel.session_id != current_id:
+                if current:
+                    yield current_id, current
+                current_id = channel.session_id
+                current = dict(session_consoles.get(current_id, {}))
+                current['channels'] = []
+            current['channels'].append(channel.export())
+
+        if current:
+            yield current_id, current
 
-        try:
-            for channel in session.query(ProxyChannel).all():
-                session_id = channel.session_id
-                if session_id not in out:
-                    out[session_id] = session_consoles.get(session_id, {})
-                    out[session_id]['channels'] = []
-
-                if not session_id:
-                    session_id = 'Unknown'
-                if session_id in out:
-                    out[session_id]['channels'].append(channel.export())
-        except exc.NoResultFound:
-            ...
 
-    return out
+def get_sessions():
+    return dict(iter_sessions())
 
 
 class AuditEvent(Base):
@@ -628,32 +1025,151 @@ def add_audit_event(source, uuid, session_id, channel, node, pid, message):
     LOG.info('Audit: %s' % message)
 
 
-def count_audit_events(source, uuid):
-    with Session(ENGINE) as session:
-        try:
-            c = session.query(AuditEvent).\
-                filter(AuditEvent.source == source).\
-                filter(AuditEvent.uuid == uuid).\
-                count()
-            return c
-        except exc.NoResultFound:
-            ...
-    return 0
+def _filter_audit_events(query, source, uuid, since=None, until=None):
+    # All audit queries are constrained to a single console and a time range,
+    # which lets them be answered from the (source, uuid, timestamp) primary
+    # key rather than scanning the table.
+    query = query.\
+        filter(AuditEvent.source == source).\
+        filter(AuditEvent.uuid == uuid)
+    if since is not None:
+        query = query.filter(AuditEvent.timestamp >= since)
+    if until is not None:
+        query = query.filter(AuditEvent.timestamp < until)
+    return query
+
+
+def count_audit_events(source, uuid, since=None, until=None, limit=None):
+    # If a limit is specified we stop counting once we have found that many
+    # events, so the result is a lower bound for consoles with a long history.
+    with Session(READ_ENGINE) as session:
+        query = _filter_audit_events(
+            session.query(AuditEvent.timestamp), source, uuid, since=since,
+            until=until)
+        if limit:
+            query = query.limit(limit)
+        return session.query(func.count()).select_from(query.subquery()).scalar()
+
+
+def get_audit_events(source, uuid, limit=20, since=None, until=None, before=None):
+    # Returns the most recent events in the time range, optionally only those
+    # older than the timestamp "before". The result is in chronological order,
+    # so the first event's timestamp is the cursor for the next older page.
+    out = []
+    with Session(READ_ENGINE) as session:
+        query = _filter_audit_events(
+            session.query(AuditEvent), source, uuid, since=since, until=until)
+        if before is not None:
+            query = query.filter(AuditEvent.timestamp < before)
+
+        for e in query.\
+                order_by(desc(AuditEvent.timestamp)).\
+                limit(limit).\
+                all():
+            out.append(e.export())
 
+    out.reverse()
+    return out
 
-def get_audit_events(source, uuid, limit=20):
+
+def iter_audit_events(source, uuid, since=None, until=None, batch_size=1000):
+    # Yield all events in the time range in chronological order. We walk the
+    # primary key in batches so that no single query holds a large result set.
+    after = None
+    while True:
+        with Session(READ_ENGINE) as session:
+            query = _filter_audit_events(
+                session.query(AuditEvent), source, uuid, since=since,
+                until=until)
+            if after:
+                query = query.filter(AuditEvent.timestamp > after)
+            batch = [e.export() for e in query.
+                     order_by(AuditEvent.timestamp).
+                     limit(batch_size).
+                     all()]
+
+        for event in batch:
+            yield event
+
+        if len(batch) < batch_size:
+            return
+        after = batch[-1]['timestamp']
+
+
+def get_recent_audit_events(after, limit=1000):
+    # Return events across all consoles after the (timestamp, source, uuid)
+    # cursor "after", in cursor order, for the change feed. Events are keyed
+    # by console and timestamp, so the cursor is unique.
     out = []
-    with Session(ENGINE) as session:
-        try:
-            for e in session.query(AuditEvent).\
-                    filter(AuditEvent.source == source).\
-                    filter(AuditEvent.uuid == uuid).\
-                    order_by(desc(AuditEvent.timestamp)).\
-                    limit(limit).\
-                    all():
-                out.append(e.export())
-        except exc.NoResultFound:
-            ...
+    with Session(READ_ENGINE) as session:
+        query = session.query(AuditEvent)
+        if after:
+            timestamp, source, uuid = after
+            query = query.filter(or_(
+                AuditEvent.timestamp > timestamp,
+                and_(AuditEvent.timestamp == timestamp, or_(
+                    AuditEvent.source > source,
+                    and_(AuditEvent.source == source, AuditEvent.uuid > uuid)))))
+        for e in query.\
+                order_by(AuditEvent.timestamp, AuditEvent.source, AuditEvent.uuid).\
+                limit(limit).\
+                all():
+            out.append(e.export())
+    return out
 
-    out.reverse()
+
+def get_latest_audit_cursor():
+    # Return the change feed cursor for the newest audit event, or None.
+    with Session(READ_ENGINE) as session:
+        e = session.query(AuditEvent).\
+            order_by(desc(AuditEvent.timestamp), desc(AuditEvent.source),
+                     desc(AuditEvent.uuid)).\
+            first()
+        if not e:
+            return None
+        return (e.timestamp, e.source, e.uuid)
+
+
+def get_audit_events_before(cutoff, limit):
+    # Return the oldest events across all consoles which are older than the
+    # cutoff, for the retention policy.
+    out = []
+    with Session(ENGINE) as session:
+        for e in session.query(AuditEvent).\
+                filter(AuditEvent.timestamp < cutoff).\
+                order_by(AuditEvent.timestamp).\
+                limit(limit).\
+                all():
+            out.append(e.export())
     return out
+
+
+def remove_audit_events(events):
+    if not events:
+        return
+
+    with Session(ENGINE) as session:
+        session.query(AuditEvent).\
+            filter(tuple_(AuditEvent.source, AuditEvent.uuid, AuditEvent.timestamp).in_(
+                [(e['source'], e['uuid'], e['timestamp']) for e in events])).\
+            delete(synchronize_session=False)
+        session.commit()
+
+
+def get_audit_table_statistics():
+    # These are estimates maintained by MySQL, which is much cheaper than
+    # counting a large table.
+    with Session(ENGINE) as session:
+        row = session.execute(text(
+            'SELECT table_rows, data_length, index_length '
+            'FROM information_schema.tables '
+            'WHERE table_schema = DATABASE() AND table_name = :name'),
+            {'name': AuditEvent.__tablename__}).one_or_none()
+
+    if not row:
+        return None
+    return {
+        'rows': row[0],
+        'data_bytes': row[1],
+        'index_bytes': row[2]
+    }
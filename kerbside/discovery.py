@@ -0,0 +1,553 @@
+# The discovery process. This polls each source for consoles on its own
+# schedule, reaps expired console tokens and applies the audit retention
+# policy. It runs separately from the daemon's supervision loop so that a
+# slow or hung cloud API can never delay supervision, and polls run on worker
+# threads so that they can never delay token reaping either.
+#
+# These tasks are cluster wide, so only the node holding the maintenance
+# lease performs them.
+
+from concurrent import futures
+import datetime
+import gzip
+import json
+import logging
+import os
+from prometheus_client import CollectorRegistry, Counter, Gauge, start_http_server
+import random
+import setproctitle
+from shakenfist_utilities import logs
+import signal
+import sys
+import time
+import yaml
+
+from .config import config
+from . import db as kerbside_db
+from .sources import registry as source_registry
+from . import util
+
+
+LOG, _ = logs.setup(__name__, **util.configure_logging())
+
+
+# Metrics for maintenance tasks are kept in their own registry, as the
+# daemon's other processes export their own metrics.
+METRICS_REGISTRY = CollectorRegistry()
+AUDIT_ROWS = Gauge(
+    'audit_events_rows', 'Estimated number of rows in the audit events table',
+    registry=METRICS_REGISTRY)
+AUDIT_BYTES = Gauge(
+    'audit_events_bytes', 'Estimated size of the audit events table and indexes',
+    registry=METRICS_REGISTRY)
+AUDIT_EXPIRED = Counter(
+    'audit_events_expired', 'Audit events removed by the retention policy',
+    registry=METRICS_REGISTRY)
+AUDIT_ARCHIVED = Counter(
+    'audit_events_archived', 'Audit events archived before removal',
+    registry=METRICS_REGISTRY)
+SOURCE_POLL_DURATION = Gauge(
+    'source_poll_seconds', 'Time taken by the most recent poll of a source',
+    ['source'], registry=METRICS_REGISTRY)
+SOURCE_POLL_ERRORS = Counter(
+    'source_poll_errors', 'Polls of a source which failed or timed out',
+    ['source'], registry=METRICS_REGISTRY)
+SOURCE_CONSOLES = Gauge(
+    'source_consoles', 'Consoles found by the most recent poll of a source',
+    ['source'], registry=METRICS_REGISTRY)
+SOURCE_BREAKER_STATE = Gauge(
+    'source_breaker_state',
+    'Circuit breaker state of a source, 0 is closed, 1 half-open and 2 open',
+    ['source'], registry=METRICS_REGISTRY)
+SOURCE_BREAKER_FAILURES = Gauge(
+    'source_breaker_failures', 'Consecutive failed polls of a source',
+    ['source'], registry=METRICS_REGISTRY)
+
+MAINTENANCE_LEASE = 'maintenance'
+
+# How often we take or renew the maintenance lease
+LEASE_RENEW_INTERVAL = 10
+
+# Sources are polled by a pool of worker threads. We track the poll of each
+# source which is in progress, and when it started, so that a hung source is
+# reported once it passes its deadline and is not polled again until its
+# previous poll has finished.
+POLL_EXECUTOR = futures.ThreadPoolExecutor(
+    max_workers=config.SOURCE_POLL_WORKERS, thread_name_prefix='kerbside-poll')
+POLLING = {}
+POLL_STARTED = {}
+
+# Applying the audit retention policy can take a while, so it also runs on its
+# own worker thread, and at most one pass runs at a time.
+RETENTION_EXECUTOR = futures.ThreadPoolExecutor(
+    max_workers=1, thread_name_prefix='kerbside-retention')
+RETENTION = None
+TIMED_OUT = set()
+
+# Sources which have completed a poll, successfully or not, since the last
+# time every configured source had. Each time this covers all sources we
+# increment the discovery version, which API servers use to report whether
+# they are serving a freshly discovered inventory.
+ROUND_COMPLETED = set()
+
+# A circuit breaker for each source. A source which fails several polls in a
+# row is opened, and is then only probed once its backoff has passed. While
+# probing it is half-open, and a successful probe closes it again. The state
+# is stored with the source so that it survives a change of lease holder, and
+# is shown in the API.
+BREAKER_CLOSED = 'closed'
+BREAKER_HALF_OPEN = 'half-open'
+BREAKER_OPEN = 'open'
+BREAKER_STATES = [BREAKER_CLOSED, BREAKER_HALF_OPEN, BREAKER_OPEN]
+BREAKERS = {}
+
+
+class SourceTimeout(Exception):
+    ...
+
+
+def _update_source_configuration(source):
+    stored_source = kerbside_db.get_source(source['source'])
+
+    # If this source is new, record it with the configured CA cert
+    # (if any).
+    if not stored_source:
+        LOG.info('Creating new source %s' % source['source'])
+        kerbside_db.add_source(
+            source['source'], source['type'], source['url'],
+            source['username'], source['password'],
+            project_name=source.get('project_name'),
+            user_domain_id=source.get('user_domain_id'),
+            project_domain_id=source.get('project_domain_id'),
+            flavor=';'.join(source.get('flavor', [])),
+            errored=False, ca_cert=source.get('ca_cert'))
+        return
+
+    # Ensure that the sources.yaml configuration for the source has
+    # not changed.
+    dirty = False
+    for field in ['type', 'url', 'username', 'password', 'project_name',
+                  'user_domain_id', 'project_domain_id', 'flavor',
+                  'deleted', 'ca_cert']:
+        if field == 'deleted':
+            new_value = False
+        elif field != 'flavor':
+            new_value = source.get(field)
+        elif source.get(field):
+            new_value = ';'.join(source.get(field))
+        else:
+            new_value = None
+
+        if stored_source[field] != new_value:
+            LOG.with_fields({
+                'old': stored_source[field],
+                'new': source.get(field)
+                }).info('Source configuration changed for source %s'
+                        % source['source'])
+            dirty = True
+
+    if dirty:
+        LOG.info('Updating source %s' % source['source'])
+        kerbside_db.add_source(
+            source['source'], source['type'], source['url'],
+            source['username'], source['password'],
+            project_name=source.get('project_name'),
+            user_domain_id=source.get('user_domain_id'),
+            project_domain_id=source.get('project_domain_id'),
+            flavor=';'.join(source.get('flavor', [])),
+            errored=False, ca_cert=source.get('ca_cert'))
+
+
+def _poll_source(source, timeout):
+    # Record the consoles for a single source, returning the uuids of the
+    # consoles seen and of those we already knew about. This runs in a worker
+    # thread, and gives up once the deadline has passed.
+    deadline = time.time() + timeout
+    POLL_STARTED[source['source']] = time.time()
+    _update_source_configuration(source)
+
+    # Drivers are kept between cycles so that they can reuse their
+    # authenticated sessions and connections. The registry rebuilds a driver
+    # if its configuration changes, and we discard it if it fails.
+    # Most consoles are unchanged from one poll to the next, so we compare
+    # a digest of each console with what is in the database and only write
+    # those which are new or have changed.
+    known = kerbside_db.get_console_digests(source['source'])
+    seen = set()
+    try:
+        lookup = source_registry.get_driver(source)
+        if lookup.errored:
+            raise Exception('source initialization failed')
+
+        for console in lookup():
+            if time.time() > deadline:
+                raise SourceTimeout('timed out after %d consoles' % len(seen))
+
+            seen.add(console['uuid'])
+            if known.get(console['uuid']) == kerbside_db.console_digest(console):
+                continue
+
+            LOG.with_fields(console).info('Found new or changed console')
+            console_is_new = kerbside_db.add_console(**console)
+            if console_is_new:
+                kerbside_db.add_audit_event(
+                    console['source'], console['uuid'], None, None, None, None,
+                    'Discovered new console'
+                )
+
+    except Exception:
+        source_registry.discard(source['source'])
+        raise
+
+    return seen, set(known)
+
+
+def _remove_consoles(consoles):
+    for console in consoles:
+        LOG.with_fields(console).info(
+            'Console is no longer available, cleaning up')
+        kerbside_db.remove_console(source=console['source'], uuid=console['uuid'])
+        kerbside_db.add_audit_event(
+            console['source'], console['uuid'], None, None, None, None,
+            'Console no longer available')
+
+
+def _load_sources():
+    if not os.path.exists(config.SOURCES_PATH):
+        LOG.error('Sources configuration at %s does not exist!' % config.SOURCES_PATH)
+        return None
+
+    with open(config.SOURCES_PATH) as f:
+        sources = {}
+        for source in yaml.safe_load(f):
+            sources[source['source']] = source
+        return sources
+
+
+def _remove_extra_sources(sources):
+    for source in kerbside_db.get_sources():
+        if source['name'] in sources:
+            continue
+
+        source_registry.discard(source['name'])
+        BREAKERS.pop(source['name'], None)
+        _remove_consoles(
+            [{'source': source['name'], 'uuid': uuid}
+             for uuid in kerbside_db.get_console_digests(source['name'])])
+        kerbside_db.delete_source(source['name'])
+        kerbside_db.add_audit_event(
+            source['name'], '', None, None, None, None, 'Source no longer available')
+
+
+def _get_breaker(name):
+    if name not in BREAKERS:
+        stored_source = kerbside_db.get_source(name)
+        breaker = {'state': BREAKER_CLOSED, 'failures': 0, 'retry_at': 0}
+        if stored_source:
+            breaker['state'] = stored_source['breaker_state']
+            breaker['failures'] = stored_source['breaker_failures']
+            if stored_source['breaker_retry_at']:
+                breaker['retry_at'] = stored_source['breaker_retry_at'].timestamp()
+        BREAKERS[name] = breaker
+    return BREAKERS[name]
+
+
+def _set_breaker(name, state, failures, retry_at):
+    BREAKERS[name] = {'state': state, 'failures': failures, 'retry_at': retry_at}
+    SOURCE_BREAKER_STATE.labels(name).set(BREAKER_STATES.index(state))
+    SOURCE_BREAKER_FAILURES.labels(name).set(failures)
+
+    # A new source is only added to the database by its first poll
+    if kerbside_db.get_source(name):
+        kerbside_db.set_source_breaker_state(
+            name, state, failures,
+            datetime.datetime.fromtimestamp(retry_at) if retry_at else None)
+
+
+def _record_poll_result(name, succeeded):
+    breaker = _get_breaker(name)
+    if succeeded:
+        if breaker['state'] != BREAKER_CLOSED:
+            LOG.info('Closing circuit breaker for source %s' % name)
+        if breaker['state'] != BREAKER_CLOSED or breaker['failures']:
+            _set_breaker(name, BREAKER_CLOSED, 0, 0)
+        return
+
+    failures = breaker['failures'] + 1
+    if (breaker['state'] == BREAKER_HALF_OPEN
+            or failures >= config.SOURCE_BREAKER_THRESHOLD):
+        backoff = min(
+            config.SOURCE_BACKOFF_INITIAL
+            * 2 ** max(failures - config.SOURCE_BREAKER_THRESHOLD, 0),
+            config.SOURCE_BACKOFF_MAX)
+        LOG.warning('Opening circuit breaker for source %s after %d failed '
+                    'polls, will probe again in %d seconds'
+                    % (name, failures, backoff))
+        _set_breaker(name, BREAKER_OPEN, failures, time.time() + backoff)
+    else:
+        _set_breaker(name, breaker['state'], failures, 0)
+
+
+def _reset_breaker(name):
+    # A source whose configuration changes is given a fresh chance
+    if BREAKERS.get(name, {}).get('state', BREAKER_CLOSED) != BREAKER_CLOSED:
+        LOG.info('Resetting circuit breaker for reconfigured source %s' % name)
+        _set_breaker(name, BREAKER_CLOSED, 0, 0)
+
+
+def _start_poll(source):
+    # Each source can set its own interval, jitter and deadline in
+    # sources.yaml, and otherwise uses the configured defaults. Jitter spreads
+    # the polls of sources with the same interval over time.
+    interval = source.get('interval', config.DISCOVERY_INTERVAL)
+    jitter = source.get('jitter', config.DISCOVERY_JITTER)
+    timeout = source.get('deadline', config.SOURCE_POLL_TIMEOUT)
+
+    # A source with an open circuit breaker is not polled until its backoff
+    # has passed, and then only one probing poll is made. Skipped sources
+    # still count towards a discovery round, as waiting for them would
+    # leave API servers unready for as long as the source is down.
+    breaker = _get_breaker(source['source'])
+    if breaker['state'] == BREAKER_OPEN:
+        if time.time() < breaker['retry_at']:
+            ROUND_COMPLETED.add(source['source'])
+            return min(breaker['retry_at'], time.time() + interval)
+        LOG.info('Probing source %s' % source['source'])
+        _set_breaker(source['source'], BREAKER_HALF_OPEN, breaker['failures'],
+                     breaker['retry_at'])
+
+    POLL_STARTED.pop(source['source'], None)
+    POLLING[source['source']] = (POLL_EXECUTOR.submit(_poll_source, source, timeout),
+                                 timeout)
+    return time.time() + interval + random.uniform(0, jitter)
+
+
+def _check_polls():
+    # Reconcile polls which have completed, and report those which have run
+    # past their deadline. The poll itself gives up at the deadline too, but
+    # it can only do that between consoles.
+    for name, (future, timeout) in list(POLLING.items()):
+        started = POLL_STARTED.get(name)
+
+        if not future.done():
+            if (started and time.time() - started > timeout + 10
+                    and name not in TIMED_OUT):
+                LOG.warning('Timed out while querying source %s' % name)
+                SOURCE_POLL_DURATION.labels(name).set(time.time() - started)
+                SOURCE_POLL_ERRORS.labels(name).inc()
+                kerbside_db.set_source_error_state(name, True)
+                _record_poll_result(name, False)
+                TIMED_OUT.add(name)
+                ROUND_COMPLETED.add(name)
+            continue
+
+        del POLLING[name]
+        ROUND_COMPLETED.add(name)
+        if name in TIMED_OUT:
+            TIMED_OUT.remove(name)
+            continue
+
+        if started:
+            SOURCE_POLL_DURATION.labels(name).set(time.time() - started)
+
+        try:
+            seen, known = future.result()
+        except Exception as e:
+            LOG.warning('Exception while querying source %s: %s' % (name, e))
+            SOURCE_POLL_ERRORS.labels(name).inc()
+            kerbside_db.set_source_error_state(name, True)
+            _record_poll_result(name, False)
+            continue
+
+        LOG.info('Source %s yielded %d consoles' % (name, len(seen)))
+        SOURCE_CONSOLES.labels(name).set(len(seen))
+        kerbside_db.set_source_error_state(name, False)
+        _record_poll_result(name, True)
+
+        # Consoles are only removed for sources which polled successfully, so
+        # that a transient failure does not empty a source.
+        _remove_consoles(
+            [{'source': name, 'uuid': uuid} for uuid in known - seen])
+
+
+def _reap_expired_console_tokens():
+    for expired in kerbside_db.reap_expired_tokens():
+        kerbside_db.add_audit_event(
+            expired['source'], expired['uuid'], expired['session_id'],
+            None, None, None, 'Reaped expired and unused token')
+
+
+def _archive_encoder(value):
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    raise TypeError('%s is not JSON serializable' % type(value))
+
+
+def _apply_audit_retention():
+    if config.AUDIT_RETENTION_DAYS > 0:
+        cutoff = (datetime.datetime.now() -
+                  datetime.timedelta(days=config.AUDIT_RETENTION_DAYS))
+        archive = None
+        archive_file = None
+        removed = 0
+
+        try:
+            # Each batch is its own short transaction so that we never hold
+            # locks on the audit table for long. A large backlog is worked
+            # through over several passes.
+            for _ in range(config.AUDIT_RETENTION_MAX_BATCHES):
+                events = kerbside_db.get_audit_events_before(
+                    cutoff, config.AUDIT_RETENTION_BATCH_SIZE)
+                if not events:
+                    break
+
+                if config.AUDIT_ARCHIVE_PATH:
+                    if not archive:
+                        # Each day's events are appended to one archive, as a
+                        # new gzip member per run. Audit events are sensitive,
+                        # so the archive is only readable by us.
+                        os.makedirs(config.AUDIT_ARCHIVE_PATH, mode=0o700, exist_ok=True)
+                        archive_path = os.path.join(
+                            config.AUDIT_ARCHIVE_PATH, 'auditevents-%s.jsonl.gz'
+                            % datetime.datetime.now().strftime('%Y%m%d'))
+                        fd = os.open(archive_path,
+                                     os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o600)
+                        os.fchmod(fd, 0o600)
+                        archive_file = os.fdopen(fd, 'ab')
+                        archive = gzip.open(archive_file, 'at')
+                    for event in events:
+                        archive.write(json.dumps(event, default=_archive_encoder) + '\n')
+                    archive.flush()
+                    AUDIT_ARCHIVED.inc(len(events))
+
+                kerbside_db.remove_audit_events(events)
+                AUDIT_EXPIRED.inc(len(events))
+                removed += len(events)
+
+                if len(events) < config.AUDIT_RETENTION_BATCH_SIZE:
+                    break
+
+        finally:
+            if archive:
+                archive.close()
+            if archive_file:
+                archive_file.close()
+
+        if removed:
+            LOG.info('Removed %d audit events older than %s' % (removed, cutoff))
+
+    stats = kerbside_db.get_audit_table_statistics()
+    if stats:
+        AUDIT_ROWS.set(stats['rows'] or 0)
+        AUDIT_BYTES.set((stats['data_bytes'] or 0) + (stats['index_bytes'] or 0))
+
+
+def _complete_round():
+    kerbside_db.bump_version(kerbside_db.DISCOVERY_VERSION)
+    ROUND_COMPLETED.clear()
+    LOG.info('All sources have been polled')
+
+
+def _run_task(name, task):
+    # A failure in one task, for example because the database is briefly
+    # unavailable, should not stop the scheduler.
+    try:
+        task()
+    except Exception as e:
+        LOG.exception('Discovery task %s failed: %s' % (name, e))
+
+
+def _handle_sigterm(signum, frame):
+    LOG.info('Discovery stopping')
+    sys.exit(0)
+
+
+def run():
+    global RETENTION
+
+    setproctitle.setproctitle('kerbside-discovery')
+    if config.LOG_VERBOSE:
+        LOG.setLevel(logging.DEBUG)
+    LOG.info('Discovery starting')
+
+    start_http_server(config.PROMETHEUS_DAEMON_METRICS_PORT,
+                      registry=METRICS_REGISTRY)
+
+    leader = False
+    last_lease = 0
+    sources = {}
+    sources_mtime = None
+    next_poll = {}
+    next_reap = 0
+    next_retention = 0
+    next_empty_round = 0
+
+    # The daemon stops us with SIGTERM. Exiting via SystemExit rather than
+    # the default handler lets us close our source drivers.
+    signal.signal(signal.SIGTERM, _handle_sigterm)
+    try:
+        while True:
+            if time.time() - last_lease > LEASE_RENEW_INTERVAL:
+                try:
+                    is_leader = kerbside_db.acquire_lease(
+                        MAINTENANCE_LEASE, config.NODE_NAME,
+                        config.MAINTENANCE_LEASE_DURATION)
+                except Exception as e:
+                    LOG.warning('Failed to renew the maintenance lease: %s' % e)
+                    is_leader = False
+                if is_leader != leader:
+                    LOG.info('%s the maintenance lease'
+                             % ('Acquired' if is_leader else 'Lost'))
+                    sources_mtime = None
+                    BREAKERS.clear()
+                leader = is_leader
+                last_lease = time.time()
+
+            _run_task('poll reconciliation', _check_polls)
+
+            if not leader:
+                time.sleep(1)
+                continue
+
+            # Reload sources.yaml when it changes
+            try:
+                mtime = os.stat(config.SOURCES_PATH).st_mtime
+            except OSError:
+                mtime = None
+            if mtime != sources_mtime:
+                sources_mtime = mtime
+                try:
+                    loaded = _load_sources()
+                    if loaded is not None:
+                        for name, source in loaded.items():
+                            if name in sources and sources[name] != source:
+                                _reset_breaker(name)
+                                next_poll.pop(name, None)
+                        sources = loaded
+                        _remove_extra_sources(sources)
+                except Exception as e:
+                    LOG.exception('Failed to load sources: %s' % e)
+
+            # With no sources configured every round is trivially complete, but
+            # we only record one per discovery interval.
+            if (ROUND_COMPLETED.issuperset(sources)
+                    and (sources or time.time() >= next_empty_round)):
+                _run_task('discovery round', _complete_round)
+                next_empty_round = time.time() + config.DISCOVERY_INTERVAL
+
+            for name, source in sources.items():
+                if name not in POLLING and time.time() >= next_poll.get(name, 0):
+                    next_poll[name] = _start_poll(source)
+
+            if time.time() >= next_reap:
+                _run_task('token reaping', _reap_expired_console_tokens)
+                next_reap = time.time() + config.TOKEN_REAP_INTERVAL
+
+            if time.time() >= next_retention and (not RETENTION or RETENTION.done()):
+                RETENTION = RETENTION_EXECUTOR.submit(
+                    _run_task, 'audit retention', _apply_audit_retention)
+                next_retention = time.time() + 60
+
+            time.sleep(1)
+    finally:
+        source_registry.close_all()
@@ -2,6 +2,7 @@
 
 from cryptography.hazmat.primitives.asymmetric import padding
 from cryptography.hazmat.primitives import hashes
+import datetime
 import logging
 import multiprocessing
 import os
@@ -29,6 +30,12 @@ from . import util
 LOG, _ = logs.setup(__name__, **util.configure_logging())
 
 
+# Secure workers only record their channel once the client has presented a
+# valid token, so until then they are protected from the stray worker cleanup
+# by their process name for this many seconds.
+HANDSHAKE_TIMEOUT = 30
+
+
 class MissingFileException(Exception):
     ...
 
@@ -181,6 +188,7 @@ class SpiceTLSSession(object):
 
         self.last_statistics = time.time() - 9
         self.session_id = None
+        self.created = None
 
         self.log = LOG.with_fields({
             'connection_type': 'secure',
@@ -216,7 +224,7 @@ class SpiceTLSSession(object):
             self.processing_time_consumed = 0
 
     def run(self, prometheus_updates):
-        db.record_channel_info(config.NODE_NAME, os.getpid())
+        self.created = datetime.datetime.now()
         self.prometheus_updates = prometheus_updates
         setproctitle.setproctitle('kerbside-secure-new')
         if config.LOG_VERBOSE:
@@ -311,13 +319,6 @@ class SpiceTLSSession(object):
             self.chan_id = parser.chan_id
             self.capabilities = parser.capabilities
             self.private_key = parser.private_key
-
-            db.record_channel_info(
-                config.NODE_NAME, os.getpid(), client_ip=self.client_host,
-                client_port=self.client_port, connection_id=self.conn_id,
-                channel_type=constants.channel_num_to_str[self.chan_type],
-                channel_id=self.chan_id)
-
             self.client_next_packet = self.ClientPassword
         return consumed
 
@@ -368,7 +369,12 @@ class SpiceTLSSession(object):
             raise ConnectionDeclined('invalid console')
 
         self.log.with_fields(self.console).info('Requested console is valid')
-        db.record_channel_info(config.NODE_NAME, os.getpid(), session_id=self.session_id)
+        db.record_channel_info(
+            config.NODE_NAME, os.getpid(), created=self.created,
+            client_ip=self.client_host, client_port=self.client_port,
+            connection_id=self.conn_id,
+            channel_type=constants.channel_num_to_str[self.chan_type],
+            channel_id=self.chan_id, session_id=self.session_id)
         db.add_audit_event(
             self.console['source'], self.console['uuid'], self.session_id,
             constants.channel_num_to_str[self.chan_type],
@@ -563,6 +569,11 @@ def run():
                     # Active channel
                     continue
 
+                if (child.name() == 'kerbside-secure-new' and
+                        time.time() - child.create_time() < HANDSHAKE_TIMEOUT):
+                    # Handshake in progress, channel not yet recorded
+                    continue
+
                 if child.name().startswith('kerbside-secure-'):
                     # Stray!
                     os.kill(child.pid, signal.SIGKILL)
@@ -570,15 +581,20 @@ def run():
 
             # Reap terminated processes
             remaining_workers = []
+            reaped_pids = []
             for p in workers:
                 if not p.is_alive():
                     p.join(1)
-                    db.remove_proxy_channel(config.NODE_NAME, p.pid)
+                    reaped_pids.append(p.pid)
                     LOG.info('Reaped worker with pid %d, exit code %d'
                              % (p.pid, p.exitcode))
                 else:
                     remaining_workers.append(p)
 
+            # Remove the channels for all reaped workers in one go. This must
+            # happen before we accept any new connections, as the pids of the
+            # reaped workers are now free for reuse.
+            db.remove_proxy_channels(config.NODE_NAME, reaped_pids)
             workers = remaining_workers
             last_worker_management = time.time()
 
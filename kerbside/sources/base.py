@@ -1,6 +1,10 @@
 # A base class for VDI console source drivers
 
 from abc import ABC
+from concurrent import futures
+import requests
+
+from ..config import config
 
 
 class BaseSource(ABC):
@@ -10,5 +14,56 @@ class BaseSource(ABC):
     def __call__(self):
         ...
 
+    def get_console(self, uuid):
+        # Return the console for a single instance in the same form as those
+        # yielded by __call__, or None if the instance does not exist or has
+        # no usable console. This is used to resolve consoles which have not
+        # been discovered yet.
+        return None
+
+    def is_connection_error(self, e):
+        # Return True if the exception e means that we can no longer reach or
+        # authenticate to the source, and so should be rebuilt. Errors about a
+        # single instance should not cause a rebuild.
+        if isinstance(e, (ConnectionError, TimeoutError,
+                          requests.exceptions.ConnectionError,
+                          requests.exceptions.Timeout)):
+            return True
+        if isinstance(e, requests.exceptions.HTTPError) and e.response is not None:
+            return e.response.status_code in (401, 403)
+        return False
+
+    def refresh(self):
+        # Called before a long lived instance is reused. Drivers should set
+        # self.errored if they are no longer usable.
+        ...
+
     def close(self):
         ...
+
+    def fetch_concurrently(self, fetch, items):
+        # Call fetch for each item using a bounded pool of threads, yielding
+        # the results in the same order as the items. The pool lives as long
+        # as the driver, so that drivers which keep per thread connections
+        # can reuse them. Drivers which use this must call close_executor()
+        # from close().
+        if not getattr(self, 'detail_executor', None):
+            self.detail_executor = futures.ThreadPoolExecutor(
+                max_workers=config.SOURCE_DETAIL_WORKERS,
+                thread_name_prefix='kerbside-detail')
+
+        pending = []
+        try:
+            for item in items:
+                pending.append(self.detail_executor.submit(fetch, item))
+            for future in pending:
+                yield future.result()
+        finally:
+            # If our caller stops early, don't do work no one will use
+            for future in pending:
+                future.cancel()
+
+    def close_executor(self):
+        if getattr(self, 'detail_executor', None):
+            self.detail_executor.shutdown(wait=False)
+            self.detail_executor = None
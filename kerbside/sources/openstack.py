@@ -1,10 +1,14 @@
+import datetime
 import importlib
+from keystoneauth1 import exceptions as keystone_exceptions
 from keystoneauth1.identity import v3
 from keystoneauth1 import session
 from openstack import connection
 from shakenfist_utilities import logs
+import time
 
 from . import base
+from ..config import config
 from .. import util
 
 
@@ -13,6 +17,10 @@ LOG, _ = logs.setup(__name__, **util.configure_logging())
 
 OPENSTACK_CLIENT = None
 
+# How far back to extend changes-since listings, to allow for clock skew
+# between us and nova.
+CHANGES_SINCE_MARGIN = 60
+
 
 class OpenStackSource(base.BaseSource):
     def __init__(self, **kwargs):
@@ -22,6 +30,12 @@ class OpenStackSource(base.BaseSource):
         self.discovered_ca_cert = None
         self.errored = False
 
+        # Drivers are long lived, so we keep our authenticated connection and
+        # what we found in the previous discovery cycle. The keystone session
+        # re-authenticates itself when its token nears expiry.
+        self.conn = None
+        self.discovery_state = {'consoles': {}, 'last_poll': None, 'last_full': 0}
+
         if not OPENSTACK_CLIENT:
             try:
                 # TODO(mikal): this is wrong, we need to import the auth
@@ -33,8 +47,6 @@ class OpenStackSource(base.BaseSource):
                 return
 
     def _make_client(self):
-        global OPENSTACK_CLIENT
-
         auth = v3.Password(
             auth_url=self.args['url'],
             username=self.args['username'],
@@ -42,44 +54,128 @@ class OpenStackSource(base.BaseSource):
             project_name=self.args['project_name'],
             user_domain_id=self.args['user_domain_id'],
             project_domain_id=self.args['project_domain_id'])
-        return connection.Connection(session=session.Session(auth=auth))
+        return connection.Connection(session=session.Session(
+            auth=auth, timeout=config.SOURCE_READ_TIMEOUT))
+
+    def _is_candidate(self, inst):
+        log = LOG.with_fields({
+            'id': inst['id'],
+            'status': inst['status'],
+            'flavor': inst['flavor']['original_name']
+            })
+
+        if inst['status'] != 'ACTIVE':
+            log.debug('Ignoring instance with incorrect status')
+            return False
+
+        if inst['flavor']['original_name'] not in (self.args.get('flavor') or []):
+            log.debug('Ignoring instance with incorrect flavor')
+            return False
+        return True
+
+    def _get_console(self, conn, inst):
+        console_data = conn.compute.create_console(
+            inst['id'], console_type='spice-direct')
+        if 'port' not in console_data or not console_data['port']:
+            return None
+
+        return {
+            'uuid': inst['id'],
+            'source': self.args['source'],
+            'hypervisor': inst['OS-EXT-SRV-ATTR:hypervisor_hostname'],
+            'hypervisor_ip': console_data['host'],
+            'insecure_port': console_data['port'],
+            'secure_port': console_data['tls_port'],
+            'name': inst['name'],
+            'host_subject': None
+        }
 
     def __call__(self):
-        global OPENSTACK_CLIENT
         if not OPENSTACK_CLIENT:
             LOG.warning('Ignoring source %s due to missing openstack client.'
                         % self.args['source'])
             return
 
-        conn = self._make_client()
-        for inst in conn.list_servers():
-            log = LOG.with_fields({
-                'id': inst['id'],
-                'status': inst['status'],
-                'flavor': inst['flavor']['original_name']
-                })
-
-            if inst['status'] != 'ACTIVE':
-                log.debug('Ignoring instance with incorrect status')
+        # Most cycles only list the instances which have changed since the
+        # previous cycle, and only ask nova for console details for those.
+        # Any change, even one which leaves the instance on the same
+        # hypervisor such as a reboot or resize, can give it a new SPICE port.
+        # Every so often we do a full listing to catch anything we missed.
+        state = self.discovery_state
+        started = time.time()
+        full = (not state['last_poll'] or
+                started - state['last_full'] > config.OPENSTACK_FULL_RESYNC_INTERVAL)
+
+        if not self.conn:
+            self.conn = self._make_client()
+        conn = self.conn
+        if full:
+            consoles = {}
+            servers = conn.list_servers()
+        else:
+            consoles = dict(state['consoles'])
+            since = datetime.datetime.fromtimestamp(
+                state['last_poll'] - CHANGES_SINCE_MARGIN, tz=datetime.timezone.utc)
+            servers = conn.list_servers(filters={'changes_since': since.isoformat()})
+
+        to_fetch = []
+        for inst in servers:
+            consoles.pop(inst['id'], None)
+            if self._is_candidate(inst):
+                to_fetch.append(inst)
+
+        # Each console lookup is a round trip to nova, so we make several at
+        # once.
+        fetched = self.fetch_concurrently(
+            lambda inst: self._get_console(conn, inst), to_fetch)
+        for inst, console in zip(to_fetch, fetched):
+            if not console:
+                LOG.with_fields({'id': inst['id']}).debug(
+                    'Ignoring instance with not allocated SPICE port')
                 continue
+            consoles[inst['id']] = console
 
-            if inst['flavor']['original_name'] not in self.args.get('flavor'):
-                log.debug('Ignoring instance with incorrect flavor')
-                continue
+        LOG.info('%s discovery for source %s fetched %d console details'
+                 % ('Full' if full else 'Incremental', self.args['source'],
+                    len(to_fetch)))
+        state['consoles'] = consoles
+        state['last_poll'] = started
+        if full:
+            state['last_full'] = started
 
-            console_data = conn.compute.create_console(
-                inst['id'], console_type='spice-direct')
-            if 'port' not in console_data or not console_data['port']:
-                log.debug('Ignoring instance with not allocated SPICE port')
-                continue
+        for console in consoles.values():
+            yield dict(console)
 
-            yield {
-                'uuid': inst['id'],
-                'source': self.args['source'],
-                'hypervisor': inst['OS-EXT-SRV-ATTR:hypervisor_hostname'],
-                'hypervisor_ip': console_data['host'],
-                'insecure_port': console_data['port'],
-                'secure_port': console_data['tls_port'],
-                'name': inst['name'],
-                'host_subject': None
-            }
+    def get_console(self, uuid):
+        if not OPENSTACK_CLIENT:
+            return None
+
+        if not self.conn:
+            self.conn = self._make_client()
+        # get_server() searches a listing of every server, whereas this is a
+        # single request.
+        try:
+            inst = self.conn.get_server_by_id(uuid)
+        except (OPENSTACK_CLIENT.exceptions.ResourceNotFound,
+                OPENSTACK_CLIENT.exceptions.BadRequestException):
+            # Nova rejects malformed instance ids as a bad request
+            return None
+        if not inst or not self._is_candidate(inst):
+            return None
+        return self._get_console(self.conn, inst)
+
+    def is_connection_error(self, e):
+        if isinstance(e, (keystone_exceptions.ConnectionError,
+                          keystone_exceptions.AuthorizationFailure,
+                          keystone_exceptions.Unauthorized)):
+            return True
+        if (OPENSTACK_CLIENT and
+                isinstance(e, OPENSTACK_CLIENT.exceptions.HttpException)):
+            return e.status_code in (401, 403)
+        return super(OpenStackSource, self).is_connection_error(e)
+
+    def close(self):
+        self.close_executor()
+        if self.conn:
+            self.conn.close()
+            self.conn = None
@@ -3,8 +3,11 @@ import os
 import requests
 from shakenfist_utilities import logs
 import tempfile
+import threading
+import time
 
 from . import base
+from ..config import config
 from .. import util
 
 
@@ -24,6 +27,17 @@ class oVirtSource(base.BaseSource):
         self.discovered_ca_cert = None
         self.errored = False
         self.ca_tempfile = None
+        self.ca_validated = 0
+
+        # Host certificate subjects by host id, and when they were fetched
+        self.host_subjects = {}
+        self.host_subjects_fetched = 0
+
+        # oVirt SDK connections are not thread safe, so we keep one per thread
+        # and remember them all so that they can be closed.
+        self.local = threading.local()
+        self.connections = []
+        self.connections_lock = threading.Lock()
 
         if not OVIRT_SDK:
             try:
@@ -42,10 +56,14 @@ class oVirtSource(base.BaseSource):
                 f.write(self.args['ca_cert'])
             self.args['ca_file'] = self.ca_tempfile
 
+        self._validate_ca()
+
+    def _validate_ca(self):
         # Fetch the engine CA certificate
         r = requests.get(
             '%s/services/pki-resource?resource=ca-certificate&format=X509-PEM-CA'
-            % self.args['url'], verify=self.args['ca_file'])
+            % self.args['url'], verify=self.args['ca_file'],
+            timeout=(config.SOURCE_CONNECT_TIMEOUT, config.SOURCE_READ_TIMEOUT))
         if r.status_code != 200:
             LOG.warning('Ignoring source %s due to missing CA certificate from engine.'
                         % self.args['source'])
@@ -62,7 +80,17 @@ class oVirtSource(base.BaseSource):
             self.errored = True
             return
 
+        self.ca_validated = time.time()
+
+    def refresh(self):
+        # Long lived instances periodically re-check that the engine still has
+        # the CA certificate we expect.
+        if time.time() - self.ca_validated > config.SOURCE_CA_REFRESH_INTERVAL:
+            self._validate_ca()
+
     def _ensure_connection(self, connection):
+        if not connection:
+            connection = getattr(self.local, 'connection', None)
         if not connection:
             connection = OVIRT_SDK.Connection(
                 url=self.args['url'] + '/api',
@@ -71,58 +99,153 @@ class oVirtSource(base.BaseSource):
                 ca_file=self.args['ca_file'],
                 debug=False,
                 log=LOG,
+                timeout=config.SOURCE_READ_TIMEOUT,
             )
+            self.local.connection = connection
+            with self.connections_lock:
+                self.connections.append(connection)
         return connection
 
     def __call__(self):
-        global OVIRT_SDK
         if not OVIRT_SDK:
             LOG.warning('Ignoring source %s due to missing ovirt-engine-sdk4.'
                         % self.args['source'])
             return
 
-        host_cache = {}
-
         connection = self._ensure_connection(None)
         vms_service = connection.system_service().vms_service()
-        hosts_service = connection.system_service().hosts_service()
 
-        for vm in vms_service.list():
-            log = LOG.with_fields({
-                    'id': vm.id,
-                    'status': vm.status
-                    })
+        # Ask for the graphics consoles of each VM in the same request as the
+        # VM listing. As with get_console_for_vm(), consoles only include their
+        # address and port if current values are requested. The SDK's list()
+        # has no current argument, so it is passed as a query parameter.
+        # Older engines do not support follow, in which case we look the
+        # consoles up one VM at a time below.
+        try:
+            vms = vms_service.list(follow='graphics_consoles',
+                                   query={'current': 'true'})
+        except OVIRT_SDK.Error as e:
+            LOG.info('Engine for source %s does not support follow, listing '
+                     'consoles per VM: %s' % (self.args['source'], e))
+            vms = vms_service.list()
 
-            if str(vm.status) != 'up':
-                log.debug('Ignoring instance with incorrect status')
-                continue
+        running = [vm for vm in vms if self._is_running(vm)]
 
-            if vm.host.id and vm.host.id not in host_cache:
-                host = hosts_service.list(search='id=%s' % vm.host.id)[0]
-                host_cache[host.id] = host.certificate.subject
+        host_subjects = self._get_host_subjects(
+            connection, [vm.host.id for vm in running if vm.host and vm.host.id])
 
-            console, _ = self.get_console_for_vm(
-                vm.id, connection=connection, acquire_ticket=False)
+        # Engines which ignore current for followed links return consoles
+        # without an address and port. Then each console lookup is a round
+        # trip to the engine, so we make several at once. Each worker thread
+        # uses its own connection.
+        consoles = self.fetch_concurrently(self._get_console_for_listed_vm, running)
+        for vm, console in zip(running, consoles):
             if not console:
-                log.debug('Ignoring instance with no SPICE console.')
-
-            yield {
-                'uuid': vm.id,
-                'source': self.args['source'],
-                'hypervisor': '',
-                'hypervisor_ip': console.address,
-                'insecure_port': console.port,
-                'secure_port': console.tls_port,
-                'name': '%s' % vm.name,
-                'host_subject': host_cache.get(vm.host.id)
-            }
-
-        # Close the connection to the server:
-        connection.close()
+                LOG.with_fields({'id': vm.id}).debug(
+                    'Ignoring instance with no SPICE console.')
+                continue
+
+            yield self._make_console(vm, console, host_subjects)
+
+    def _is_running(self, vm):
+        if str(vm.status) != 'up':
+            LOG.with_fields({
+                'id': vm.id,
+                'status': vm.status
+                }).debug('Ignoring instance with incorrect status')
+            return False
+        return True
+
+    def _make_console(self, vm, console, host_subjects):
+        return {
+            'uuid': vm.id,
+            'source': self.args['source'],
+            'hypervisor': '',
+            'hypervisor_ip': console.address,
+            'insecure_port': console.port,
+            'secure_port': console.tls_port,
+            'name': '%s' % vm.name,
+            'host_subject': host_subjects.get(vm.host.id)
+        }
+
+    def get_console(self, uuid):
+        if not OVIRT_SDK:
+            return None
+
+        connection = self._ensure_connection(None)
+        try:
+            vm = connection.system_service().vms_service().vm_service(uuid).get()
+        except OVIRT_SDK.NotFoundError:
+            return None
+        except OVIRT_SDK.Error as e:
+            # The engine rejects malformed ids as a bad request
+            if e.code == 400:
+                return None
+            raise
+        if not self._is_running(vm):
+            return None
+
+        console, _ = self.get_console_for_vm(uuid, connection=connection)
+        if not console:
+            return None
+
+        host_ids = [vm.host.id] if vm.host and vm.host.id else []
+        return self._make_console(
+            vm, console, self._get_host_subjects(connection, host_ids))
+
+    def _get_host_subjects(self, connection, host_ids):
+        # Host certificate subjects rarely change, so we list all hosts at
+        # most once per TTL, or sooner if a VM is on a host we do not know.
+        if (time.time() - self.host_subjects_fetched < config.OVIRT_HOST_CACHE_TTL
+                and set(host_ids).issubset(self.host_subjects)):
+            return self.host_subjects
+
+        subjects = {}
+        hosts_service = connection.system_service().hosts_service()
+        for host in hosts_service.list():
+            # Hosts which are still being installed have no certificate
+            if not host.certificate:
+                continue
+            subjects[host.id] = host.certificate.subject
+        self.host_subjects = subjects
+        self.host_subjects_fetched = time.time()
+        return subjects
+
+    def _get_console_for_listed_vm(self, vm):
+        # Links which were not followed are empty lists, so we can only skip
+        # VMs whose followed consoles are known not to include SPICE.
+        followed = getattr(vm, 'graphics_consoles', None) or []
+        spice = [c for c in followed
+                 if c.protocol == OVIRT_SDK_TYPES.GraphicsType.SPICE]
+        if followed and not spice:
+            return None
+        for console in spice:
+            if console.address and console.port:
+                return console
+
+        console, _ = self.get_console_for_vm(vm.id, acquire_ticket=False)
+        return console
+
+    def is_connection_error(self, e):
+        if OVIRT_SDK and isinstance(e, (OVIRT_SDK.ConnectionError, OVIRT_SDK.AuthError)):
+            return True
+        return super(oVirtSource, self).is_connection_error(e)
 
     def close(self):
+        self.close_executor()
+        with self.connections_lock:
+            for connection in self.connections:
+                try:
+                    connection.close()
+                except Exception as e:
+                    LOG.warning('Failed to close connection for source %s: %s'
+                                % (self.args['source'], e))
+            self.connections = []
+        self.local = threading.local()
+
         if self.ca_tempfile:
             os.unlink(self.ca_tempfile)
+            self.ca_tempfile = None
 
     def get_console_for_vm(self, id, connection=None, acquire_ticket=False):
         connection = self._ensure_connection(connection)
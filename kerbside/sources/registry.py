@@ -0,0 +1,134 @@
+# A per process registry of long lived source driver instances. Building a
+# driver is expensive (CA certificate downloads and verification, temporary
+# files, authentication and TLS handshakes), so where a process needs to talk
+# to a source repeatedly it should fetch the driver from here instead of
+# constructing a new one. Drivers are keyed by source name, and are rebuilt if
+# the configuration for that source changes or the driver reports an error.
+
+import hashlib
+import importlib
+import json
+from shakenfist_utilities import logs
+import threading
+
+from .. import util
+
+
+LOG, _ = logs.setup(__name__, **util.configure_logging())
+
+
+# Drivers are imported on demand, as their client libraries are optional
+DRIVER_CLASSES = {
+    'openstack': ('kerbside.sources.openstack', 'OpenStackSource'),
+    'ovirt': ('kerbside.sources.ovirt', 'oVirtSource'),
+    'shakenfist': ('kerbside.sources.shakenfist', 'ShakenFistSource')
+}
+
+# The source configuration fields which a driver depends on
+CONFIGURATION_FIELDS = ['type', 'url', 'username', 'password', 'project_name',
+                        'user_domain_id', 'project_domain_id', 'flavor',
+                        'ca_cert']
+
+DRIVERS = {}
+DRIVERS_LOCK = threading.Lock()
+
+
+class UnknownSourceType(Exception):
+    ...
+
+
+def _normalize(source):
+    # Sources from sources.yaml name themselves with "source", whereas sources
+    # from the database use "name". The database also stores flavors as a
+    # semicolon separated string. Drivers expect the sources.yaml form.
+    args = dict(source)
+    args.setdefault('source', args.get('name'))
+    args.pop('name', None)
+    if isinstance(args.get('flavor'), str):
+        args['flavor'] = [f for f in args['flavor'].split(';') if f]
+    return args
+
+
+def _fingerprint(args):
+    return hashlib.sha256(json.dumps(
+        [args.get(field) for field in CONFIGURATION_FIELDS]).encode()).hexdigest()
+
+
+def build_driver(source):
+    # Construct a new driver which is not tracked by the registry.
+    if source['type'] not in DRIVER_CLASSES:
+        raise UnknownSourceType('unknown source type %s' % source['type'])
+
+    module_name, class_name = DRIVER_CLASSES[source['type']]
+    driver_class = getattr(importlib.import_module(module_name), class_name)
+    return driver_class(**_normalize(source))
+
+
+def get_driver(source):
+    # Returns a driver for the source, which might be errored. The caller must
+    # not close the driver, use discard() instead.
+    #
+    # Refreshing and building drivers talks to the source, so neither is done
+    # while holding DRIVERS_LOCK, otherwise one slow source would block every
+    # caller for every source. Each driver has its own lock so that only one
+    # caller refreshes it at a time.
+    args = _normalize(source)
+    name = args['source']
+    fingerprint = _fingerprint(args)
+
+    with DRIVERS_LOCK:
+        existing = DRIVERS.get(name)
+
+    if existing:
+        existing_fingerprint, driver, driver_lock = existing
+        if existing_fingerprint == fingerprint and not driver.errored:
+            with driver_lock:
+                driver.refresh()
+            if not driver.errored:
+                return driver
+
+        LOG.info('Rebuilding driver for source %s' % name)
+        with DRIVERS_LOCK:
+            if DRIVERS.get(name) is existing:
+                del DRIVERS[name]
+            else:
+                existing = None
+        if existing:
+            driver.close()
+
+    driver = build_driver(source)
+    if driver.errored:
+        driver.close()
+        return driver
+
+    replaced = None
+    with DRIVERS_LOCK:
+        current = DRIVERS.get(name)
+        if current and current[0] == fingerprint and not current[1].errored:
+            # Another caller built a driver at the same time as us
+            replaced = driver
+            driver = current[1]
+        else:
+            if current:
+                replaced = current[1]
+            DRIVERS[name] = (fingerprint, driver, threading.Lock())
+    if replaced:
+        replaced.close()
+    return driver
+
+
+def discard(name):
+    # Forget a driver, for example because a request made with it failed in a
+    # way which suggests its connections are no longer usable.
+    with DRIVERS_LOCK:
+        existing = DRIVERS.pop(name, None)
+    if existing:
+        existing[1].close()
+
+
+def close_all():
+    with DRIVERS_LOCK:
+        drivers = list(DRIVERS.values())
+        DRIVERS.clear()
+    for _, driver, _ in drivers:
+        driver.close()
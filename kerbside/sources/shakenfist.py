@@ -1,7 +1,9 @@
 import importlib
 from shakenfist_utilities import logs
+import time
 
 from . import base
+from ..config import config
 from .. import util
 
 
@@ -28,6 +30,17 @@ class ShakenFistSource(base.BaseSource):
                 self.errored = True
                 return
 
+        # Drivers are long lived, so we keep our clients (which hold their
+        # authentication tokens and HTTP connections), when we last validated
+        # the CA certificate, and the addresses of hypervisor nodes.
+        self.clients = {}
+        self.ca_validated = 0
+        self.nodes = {}
+        self.nodes_fetched = 0
+
+        self.refresh()
+
+    def _validate_ca(self):
         # Fetch the cluster CA certificate
         system_client = self._make_client('system')
         self.discovered_ca_cert = system_client.get_cluster_cacert()
@@ -41,48 +54,96 @@ class ShakenFistSource(base.BaseSource):
             self.errored = True
             return
 
+        self.ca_validated = time.time()
+
+    def refresh(self):
+        # Long lived instances periodically re-check that the cluster still
+        # has the CA certificate we expect.
+        if time.time() - self.ca_validated > config.SOURCE_CA_REFRESH_INTERVAL:
+            self._validate_ca()
+
     def _make_client(self, namespace):
-        global SHAKENFIST_CLIENT
-        return SHAKENFIST_CLIENT.Client(
-            base_url=self.args['url'], namespace=namespace, key=self.args['password'],
-            async_strategy=SHAKENFIST_CLIENT.ASYNC_BLOCK)
+        if namespace not in self.clients:
+            self.clients[namespace] = SHAKENFIST_CLIENT.Client(
+                base_url=self.args['url'], namespace=namespace,
+                key=self.args['password'],
+                async_strategy=SHAKENFIST_CLIENT.ASYNC_BLOCK)
+        return self.clients[namespace]
+
+    def _get_nodes(self, names):
+        # Hypervisor nodes rarely change, so we list them at most once per
+        # TTL, or sooner if an instance is on a node we do not know.
+        if (time.time() - self.nodes_fetched > config.SHAKENFIST_NODE_CACHE_TTL
+                or not names.issubset(self.nodes)):
+            # We need to be an admin user to lookup the hypervisors
+            nodes = {}
+            for node in self._make_client('system').get_nodes():
+                nodes[node['name']] = node['ip']
+            self.nodes = nodes
+            self.nodes_fetched = time.time()
+        return self.nodes
+
+    def _is_console(self, inst):
+        log = LOG.with_fields({
+                'uuid': inst['uuid'],
+                'state': inst['state'],
+                'video': inst['video']
+                })
+
+        if inst['state'] != 'created':
+            log.debug('Ignoring instance in incorrect state')
+            return False
+        if not inst['video']['vdi'].startswith('spice'):
+            log.debug('Ignoring instance with incorrect VDI type')
+            return False
+        return True
+
+    def _make_console(self, inst, nodes):
+        return {
+            'uuid': inst['uuid'],
+            'source': self.args['source'],
+            'hypervisor': inst['node'],
+            'hypervisor_ip': nodes[inst['node']],
+            'insecure_port': inst['vdi_port'],
+            'secure_port': inst['vdi_tls_port'],
+            'name': '%s.%s' % (inst['name'], inst['namespace']),
+            'host_subject': None
+        }
 
     def __call__(self):
-        global SHAKENFIST_CLIENT
         if not SHAKENFIST_CLIENT:
             LOG.warning('Ignoring source %s due to missing shakenfist-client.'
                         % self.args['source'])
             return
 
-        # We need to be an admin user to lookup the hypervisors
-        system_client = self._make_client('system')
-        nodes = {}
-        for node in system_client.get_nodes():
-            nodes[node['name']] = node
-
-        # And then just lookup instances in the right namespace
+        # Lookup instances in the right namespace
         namespaced_client = self._make_client(self.args['username'])
+        instances = []
         for inst in namespaced_client.get_instances():
-            log = LOG.with_fields({
-                    'uuid': inst['uuid'],
-                    'state': inst['state'],
-                    'video': inst['video']
-                    })
-
-            if inst['state'] != 'created':
-                log.debug('Ignoring instance in incorrect state')
-                continue
-            if not inst['video']['vdi'].startswith('spice'):
-                log.debug('Ignoring instance with incorrect VDI type')
-                continue
-
-            yield {
-                'uuid': inst['uuid'],
-                'source': self.args['source'],
-                'hypervisor': inst['node'],
-                'hypervisor_ip': nodes[inst['node']]['ip'],
-                'insecure_port': inst['vdi_port'],
-                'secure_port': inst['vdi_tls_port'],
-                'name': '%s.%s' % (inst['name'], inst['namespace']),
-                'host_subject': None
-            }
+            if self._is_console(inst):
+                instances.append(inst)
+
+        nodes = self._get_nodes(set(inst['node'] for inst in instances))
+
+        for inst in instances:
+            yield self._make_console(inst, nodes)
+
+    def get_console(self, uuid):
+        if not SHAKENFIST_CLIENT:
+            return None
+
+        try:
+            inst = self._make_client(self.args['username']).get_instance(uuid)
+        except (SHAKENFIST_CLIENT.ResourceNotFoundException,
+                SHAKENFIST_CLIENT.RequestMalformedException):
+            return None
+
+        if not inst or not self._is_console(inst):
+            return None
+        return self._make_console(inst, self._get_nodes({inst['node']}))
+
+    def is_connection_error(self, e):
+        if (SHAKENFIST_CLIENT and
+                isinstance(e, SHAKENFIST_CLIENT.UnauthorizedException)):
+            return True
+        return super(ShakenFistSource, self).is_connection_error(e)
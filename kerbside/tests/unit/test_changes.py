@@ -0,0 +1,85 @@
+import datetime
+import mock
+import queue
+import testtools
+
+
+from kerbside import changes
+
+
+def _event(seconds, uuid='u1', message='Discovered new console'):
+    return {
+        'timestamp': datetime.datetime(2024, 1, 1) + datetime.timedelta(seconds=seconds),
+        'source': 'cloud',
+        'uuid': uuid,
+        'session_id': None,
+        'message': message
+    }
+
+
+class AuditCursorTestCase(testtools.TestCase):
+    def setUp(self):
+        super(AuditCursorTestCase, self).setUp()
+
+        patcher = mock.patch.object(changes.config, 'CHANGE_FEED_AUDIT_GRACE', 5)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        patcher = mock.patch.object(changes, 'db')
+        self.db = patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.q = queue.Queue()
+        changes.SUBSCRIBERS.append(self.q)
+        self.addCleanup(changes.SUBSCRIBERS.remove, self.q)
+
+    def _published(self):
+        out = []
+        while not self.q.empty():
+            out.append(self.q.get_nowait())
+        return out
+
+    def test_no_events(self):
+        self.db.get_recent_audit_events.return_value = []
+        self.assertEqual('cursor', changes._publish_audit_events('cursor', set()))
+        self.assertEqual([], self._published())
+
+    def test_event_types(self):
+        self.db.get_recent_audit_events.return_value = [
+            _event(0, message='Session terminated by request'),
+            _event(1, message='Something else')]
+        changes._publish_audit_events(None, set())
+        self.assertEqual(['session_terminated', 'audit'],
+                         [e['type'] for e in self._published()])
+
+    def test_cursor_held_within_grace(self):
+        events = [_event(0), _event(6), _event(10, uuid='u2')]
+        self.db.get_recent_audit_events.return_value = events
+        seen = set()
+
+        cursor = changes._publish_audit_events(None, seen)
+        self.assertEqual(changes._audit_key(events[0]), cursor)
+        self.assertEqual(3, len(self._published()))
+        self.assertEqual({changes._audit_key(events[1]),
+                          changes._audit_key(events[2])}, seen)
+
+    def test_late_event_published_once(self):
+        seen = set()
+        self.db.get_recent_audit_events.return_value = [_event(0), _event(10)]
+        cursor = changes._publish_audit_events(None, seen)
+        self.assertEqual(2, len(self._published()))
+
+        # An event committed late with an earlier timestamp is still after
+        # the cursor, and the events already published are not repeated.
+        self.db.get_recent_audit_events.return_value = [
+            _event(8, uuid='late'), _event(10)]
+        changes._publish_audit_events(cursor, seen)
+        self.assertEqual(['late'], [e['uuid'] for e in self._published()])
+
+    def test_full_batch_advances(self):
+        events = [_event(0, uuid='u%04d' % i) for i in range(1000)]
+        self.db.get_recent_audit_events.return_value = events
+        seen = set()
+        cursor = changes._publish_audit_events(None, seen)
+        self.assertEqual(changes._audit_key(events[-1]), cursor)
+        self.assertEqual(set(), seen)
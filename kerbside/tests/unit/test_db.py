@@ -0,0 +1,37 @@
+import testtools
+
+
+from kerbside import db
+
+
+CONSOLE = {
+    'uuid': 'e4b1bba5-51d1-4b0f-9d3b-3f3c3b4bbd4c',
+    'source': 'cloud',
+    'hypervisor': 'hv1',
+    'hypervisor_ip': '192.168.1.10',
+    'insecure_port': 5900,
+    'secure_port': 5901,
+    'name': 'desktop',
+    'host_subject': None
+}
+
+
+class ConsoleDigestTestCase(testtools.TestCase):
+    def test_stable(self):
+        self.assertEqual(db.console_digest(CONSOLE), db.console_digest(dict(CONSOLE)))
+
+    def test_discovered_fields_change_digest(self):
+        for field in db.CONSOLE_FIELDS:
+            changed = dict(CONSOLE)
+            changed[field] = 'changed'
+            self.assertNotEqual(
+                db.console_digest(CONSOLE), db.console_digest(changed), field)
+
+    def test_other_fields_ignored(self):
+        changed = dict(CONSOLE, ticket='ticket', discovered='now')
+        self.assertEqual(db.console_digest(CONSOLE), db.console_digest(changed))
+
+    def test_missing_fields_are_none(self):
+        partial = dict(CONSOLE)
+        del partial['host_subject']
+        self.assertEqual(db.console_digest(CONSOLE), db.console_digest(partial))
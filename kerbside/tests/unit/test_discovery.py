@@ -0,0 +1,156 @@
+import mock
+import testtools
+
+
+from kerbside import discovery
+
+
+SOURCE = {
+    'source': 'cloud',
+    'type': 'shakenfist',
+    'url': 'https://sf',
+    'username': 'system',
+    'password': 'secret'
+}
+
+
+class DiscoveryTestCase(testtools.TestCase):
+    def setUp(self):
+        super(DiscoveryTestCase, self).setUp()
+
+        for name, value in [('SOURCE_BREAKER_THRESHOLD', 3),
+                            ('SOURCE_BACKOFF_INITIAL', 60),
+                            ('SOURCE_BACKOFF_MAX', 200),
+                            ('DISCOVERY_INTERVAL', 60),
+                            ('DISCOVERY_JITTER', 10),
+                            ('SOURCE_POLL_TIMEOUT', 300)]:
+            patcher = mock.patch.object(discovery.config, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        self.now = 1000.0
+        patcher = mock.patch.object(discovery.time, 'time', side_effect=lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        patcher = mock.patch.object(discovery, 'kerbside_db')
+        self.db = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.db.get_source.return_value = None
+
+        patcher = mock.patch.object(discovery, 'POLL_EXECUTOR')
+        self.executor = patcher.start()
+        self.addCleanup(patcher.stop)
+
+        for state in [discovery.BREAKERS, discovery.POLLING,
+                      discovery.POLL_STARTED, discovery.ROUND_COMPLETED]:
+            state.clear()
+            self.addCleanup(state.clear)
+
+
+class BreakerTestCase(DiscoveryTestCase):
+    def _fail(self, times=1):
+        for _ in range(times):
+            discovery._record_poll_result('cloud', False)
+        return discovery.BREAKERS['cloud']
+
+    def test_new_source_is_closed(self):
+        self.assertEqual(
+            {'state': discovery.BREAKER_CLOSED, 'failures': 0, 'retry_at': 0},
+            discovery._get_breaker('cloud'))
+
+    def test_failures_below_threshold_stay_closed(self):
+        breaker = self._fail(2)
+        self.assertEqual(discovery.BREAKER_CLOSED, breaker['state'])
+        self.assertEqual(2, breaker['failures'])
+
+    def test_opens_at_threshold(self):
+        breaker = self._fail(3)
+        self.assertEqual(discovery.BREAKER_OPEN, breaker['state'])
+        self.assertEqual(1060.0, breaker['retry_at'])
+
+    def test_failed_probe_doubles_backoff(self):
+        self._fail(3)
+        discovery.BREAKERS['cloud']['state'] = discovery.BREAKER_HALF_OPEN
+
+        breaker = self._fail()
+        self.assertEqual(discovery.BREAKER_OPEN, breaker['state'])
+        self.assertEqual(4, breaker['failures'])
+        self.assertEqual(1120.0, breaker['retry_at'])
+
+    def test_backoff_is_capped(self):
+        breaker = self._fail(10)
+        self.assertEqual(1200.0, breaker['retry_at'])
+
+    def test_success_closes(self):
+        self._fail(3)
+        discovery._record_poll_result('cloud', True)
+        self.assertEqual(
+            {'state': discovery.BREAKER_CLOSED, 'failures': 0, 'retry_at': 0},
+            discovery.BREAKERS['cloud'])
+
+    def test_success_resets_failures(self):
+        self._fail(2)
+        discovery._record_poll_result('cloud', True)
+        self.assertEqual(discovery.BREAKER_CLOSED, self._fail()['state'])
+
+    def test_reset(self):
+        self._fail(3)
+        discovery._reset_breaker('cloud')
+        self.assertEqual(discovery.BREAKER_CLOSED, discovery.BREAKERS['cloud']['state'])
+
+    def test_state_persisted(self):
+        self.db.get_source.return_value = {
+            'breaker_state': discovery.BREAKER_CLOSED,
+            'breaker_failures': 0,
+            'breaker_retry_at': None
+        }
+        self._fail(3)
+        self.db.set_source_breaker_state.assert_called_with(
+            'cloud', discovery.BREAKER_OPEN, 3, mock.ANY)
+
+    def test_state_loaded(self):
+        retry_at = mock.MagicMock()
+        retry_at.timestamp.return_value = 1500.0
+        self.db.get_source.return_value = {
+            'breaker_state': discovery.BREAKER_OPEN,
+            'breaker_failures': 5,
+            'breaker_retry_at': retry_at
+        }
+        self.assertEqual(
+            {'state': discovery.BREAKER_OPEN, 'failures': 5, 'retry_at': 1500.0},
+            discovery._get_breaker('cloud'))
+
+
+class StartPollTestCase(DiscoveryTestCase):
+    def test_interval_and_jitter(self):
+        with mock.patch.object(discovery.random, 'uniform', return_value=5) as uniform:
+            next_poll = discovery._start_poll(SOURCE)
+        uniform.assert_called_with(0, 10)
+        self.assertEqual(1065.0, next_poll)
+        self.executor.submit.assert_called_with(discovery._poll_source, SOURCE, 300)
+        self.assertIn('cloud', discovery.POLLING)
+
+    def test_per_source_schedule(self):
+        source = dict(SOURCE, interval=30, jitter=0, deadline=20)
+        self.assertEqual(1030.0, discovery._start_poll(source))
+        self.executor.submit.assert_called_with(discovery._poll_source, source, 20)
+        self.assertEqual(20, discovery.POLLING['cloud'][1])
+
+    def test_open_breaker_skips_poll(self):
+        discovery.BREAKERS['cloud'] = {
+            'state': discovery.BREAKER_OPEN, 'failures': 3, 'retry_at': 1030.0}
+
+        next_poll = discovery._start_poll(dict(SOURCE, jitter=0))
+        self.assertEqual(1030.0, next_poll)
+        self.executor.submit.assert_not_called()
+        self.assertIn('cloud', discovery.ROUND_COMPLETED)
+
+    def test_open_breaker_probes_after_backoff(self):
+        discovery.BREAKERS['cloud'] = {
+            'state': discovery.BREAKER_OPEN, 'failures': 3, 'retry_at': 990.0}
+
+        discovery._start_poll(dict(SOURCE, jitter=0))
+        self.assertEqual(discovery.BREAKER_HALF_OPEN,
+                         discovery.BREAKERS['cloud']['state'])
+        self.executor.submit.assert_called_once()
@@ -0,0 +1,115 @@
+import mock
+import testtools
+
+
+from kerbside.sources import registry
+
+
+class FakeDriver(object):
+    def __init__(self, errored=False):
+        self.errored = errored
+        self.refreshed = 0
+        self.closed = False
+
+    def refresh(self):
+        self.refreshed += 1
+
+    def close(self):
+        self.closed = True
+
+
+SOURCE = {
+    'name': 'cloud',
+    'type': 'openstack',
+    'url': 'https://keystone',
+    'username': 'admin',
+    'password': 'secret',
+    'flavor': 'm1.small;m1.large'
+}
+
+
+class RegistryTestCase(testtools.TestCase):
+    def setUp(self):
+        super(RegistryTestCase, self).setUp()
+        registry.DRIVERS.clear()
+        self.addCleanup(registry.DRIVERS.clear)
+
+        self.built = []
+
+        def build(source):
+            driver = FakeDriver()
+            self.built.append(driver)
+            return driver
+
+        patcher = mock.patch.object(registry, 'build_driver', side_effect=build)
+        self.build = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_normalize_database_source(self):
+        args = registry._normalize(SOURCE)
+        self.assertEqual('cloud', args['source'])
+        self.assertNotIn('name', args)
+        self.assertEqual(['m1.small', 'm1.large'], args['flavor'])
+
+    def test_normalize_configured_source(self):
+        args = registry._normalize({'source': 'cloud', 'flavor': ['m1.small']})
+        self.assertEqual('cloud', args['source'])
+        self.assertEqual(['m1.small'], args['flavor'])
+
+    def test_fingerprint_ignores_source_form(self):
+        configured = dict(SOURCE, source='cloud', flavor=['m1.small', 'm1.large'])
+        del configured['name']
+        self.assertEqual(
+            registry._fingerprint(registry._normalize(SOURCE)),
+            registry._fingerprint(registry._normalize(configured)))
+
+    def test_reuse_driver(self):
+        first = registry.get_driver(SOURCE)
+        second = registry.get_driver(SOURCE)
+
+        self.assertIs(first, second)
+        self.assertEqual(1, self.build.call_count)
+        self.assertEqual(1, first.refreshed)
+
+    def test_rebuild_on_fingerprint_change(self):
+        first = registry.get_driver(SOURCE)
+        second = registry.get_driver(dict(SOURCE, password='changed'))
+
+        self.assertIsNot(first, second)
+        self.assertTrue(first.closed)
+        self.assertFalse(second.closed)
+        self.assertEqual(2, self.build.call_count)
+        self.assertIs(second, registry.DRIVERS['cloud'][1])
+
+    def test_rebuild_unaffected_by_other_fields(self):
+        first = registry.get_driver(SOURCE)
+        second = registry.get_driver(dict(SOURCE, interval=30))
+
+        self.assertIs(first, second)
+        self.assertEqual(1, self.build.call_count)
+
+    def test_rebuild_when_refresh_fails(self):
+        first = registry.get_driver(SOURCE)
+
+        def refresh():
+            first.errored = True
+        first.refresh = refresh
+
+        second = registry.get_driver(SOURCE)
+        self.assertIsNot(first, second)
+        self.assertTrue(first.closed)
+
+    def test_errored_driver_not_kept(self):
+        self.build.side_effect = lambda source: FakeDriver(errored=True)
+
+        driver = registry.get_driver(SOURCE)
+        self.assertTrue(driver.errored)
+        self.assertTrue(driver.closed)
+        self.assertNotIn('cloud', registry.DRIVERS)
+
+    def test_discard(self):
+        driver = registry.get_driver(SOURCE)
+        registry.discard('cloud')
+
+        self.assertTrue(driver.closed)
+        self.assertNotIn('cloud', registry.DRIVERS)